@@ -0,0 +1,129 @@
+"""Admission control for task submissions based on queue saturation.
+
+The controller keeps a short-lived cache of queue depths and an estimate of
+how fast each queue drains. A submission is shed when the expected wait in
+its priority queue exceeds the SLO for that priority class (429), or when the
+queue has hit the hard depth cap (503). Priority classes without an SLO, such
+as ``high``, are always admitted.
+
+The drain rate is only learned from sample intervals where the queue was
+non-empty at both ends, since an idle queue drains at the arrival rate, not
+at worker capacity. Drains are inferred from depth changes plus the
+submissions this process admitted, so with several API processes the others'
+arrivals hide some drains and the rate is underestimated, which sheds early.
+"""
+import logging
+import math
+import threading
+import time
+
+import celeryconfig
+from queue_metrics import RateTracker, get_queue_depths
+from tasks import PRIORITY_QUEUES
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionController:
+    def __init__(self, app, slo_seconds, max_queue_depth=None, cache_ttl=1.0,
+                 default_drain_rate=1.0):
+        self.app = app
+        self.slo_seconds = slo_seconds
+        self.max_queue_depth = max_queue_depth
+        self.cache_ttl = cache_ttl
+        self.default_drain_rate = default_drain_rate
+        self.lock = threading.Lock()
+        self.depths = {}
+        self.sampled_at = None
+        self.admitted = {}
+        self.drained = {}
+        self.drain_rates = RateTracker()
+
+    @classmethod
+    def from_config(cls, app, config=celeryconfig):
+        return cls(
+            app,
+            slo_seconds=config.admission_slo_seconds,
+            max_queue_depth=config.admission_max_queue_depth,
+            cache_ttl=config.admission_cache_ttl,
+            default_drain_rate=config.admission_default_drain_rate,
+        )
+
+    def refresh(self, now=None):
+        """Resample queue depths if the cached sample is older than cache_ttl."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            if self.sampled_at is not None and now - self.sampled_at < self.cache_ttl:
+                return
+            # Claim the refresh so concurrent requests keep using the old sample
+            self.sampled_at = now
+            queues = sorted(set(PRIORITY_QUEUES.values()))
+        depths = get_queue_depths(self.app, queues)
+        with self.lock:
+            for queue, info in depths.items():
+                depth = info['messages']
+                previous = self.depths.get(queue)
+                if previous and depth:
+                    # Whatever was queued or admitted since the last sample and is gone now was drained
+                    drained = max(previous + self.admitted.get(queue, 0) - depth, 0)
+                    self.drained[queue] = self.drained.get(queue, 0) + drained
+                    self.drain_rates.update(queue, self.drained[queue], now)
+                else:
+                    # Workers may have been idle, so this interval says nothing about capacity
+                    self.drain_rates.mark(queue, self.drained.get(queue, 0), now)
+                self.depths[queue] = depth
+                self.admitted[queue] = 0
+
+    def expected_wait(self, queue):
+        depth = self.depths.get(queue, 0)
+        if not depth:
+            return 0.0
+        rate = self.drain_rates.rate(queue)
+        if not rate:
+            rate = self.default_drain_rate
+        return depth / rate
+
+    def check(self, priority):
+        """Decide whether a submission with the given priority is admitted.
+
+        Returns a dict with ``admitted`` and, for rejections, the HTTP
+        ``status``, a ``retry_after`` hint in seconds and a ``reason``.
+        """
+        slo_key = priority if priority in self.slo_seconds else 'normal'
+        slo = self.slo_seconds.get(slo_key)
+        queue = PRIORITY_QUEUES.get(priority, 'default')
+        if slo is None:
+            return {'admitted': True, 'queue': queue}
+
+        try:
+            self.refresh()
+        except Exception as e:
+            # Fail open: losing the broker view must not take the API down
+            logger.warning(f"Admission control could not sample queues: {str(e)}")
+            return {'admitted': True, 'queue': queue}
+
+        with self.lock:
+            depth = self.depths.get(queue, 0)
+            wait = self.expected_wait(queue)
+
+        decision = {'admitted': True, 'queue': queue, 'depth': depth, 'expected_wait': wait}
+        if self.max_queue_depth and depth >= self.max_queue_depth:
+            decision.update(
+                admitted=False,
+                status=503,
+                retry_after=max(math.ceil(wait), 1),
+                reason=f"Queue {queue} is saturated ({depth} tasks waiting)",
+            )
+        elif wait > slo:
+            decision.update(
+                admitted=False,
+                status=429,
+                retry_after=max(math.ceil(wait - slo), 1),
+                reason=f"Expected wait {wait:.0f}s for {slo_key} priority exceeds {slo}s",
+            )
+        return decision
+
+    def record_admitted(self, queue):
+        """Count a submission so the next sample can tell arrivals from drains."""
+        with self.lock:
+            self.admitted[queue] = self.admitted.get(queue, 0) + 1
@@ -1,6 +1,9 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-from tasks import process_task, get_task_status, celery_app, submit_task_with_priority
+from tasks import process_task, get_task_status, celery_app, submit_task_with_priority, search_tasks, TaskError
+from task_index import parse_time
+from admission import AdmissionController
+import celeryconfig
 import os
 from dotenv import load_dotenv
 import logging
@@ -21,6 +24,9 @@ CORS(app, resources={r"/api/*": {"origins": "*"}})
 # Configure Flask to handle trailing slashes
 app.url_map.strict_slashes = False
 
+# Shed low-priority submissions when queues are saturated
+admission = AdmissionController.from_config(celery_app) if celeryconfig.admission_control_enabled else None
+
 @app.route('/')
 def index():
     return jsonify({
@@ -28,14 +34,17 @@ def index():
         'message': 'Task Processing System API',
         'endpoints': {
             'submit_task': '/api/tasks (POST)',
+            'search_tasks': '/api/tasks?state=&type=&priority=&since=&until=&limit=&offset= (GET)',
             'get_task': '/api/tasks/<task_id> (GET)'
         }
     })
 
-@app.route('/api/tasks', methods=['POST', 'OPTIONS'])
+@app.route('/api/tasks', methods=['GET', 'POST', 'OPTIONS'])
 def submit_task():
     if request.method == 'OPTIONS':
         return '', 200
+    if request.method == 'GET':
+        return list_tasks()
         
     try:
         data = request.get_json()
@@ -53,6 +62,16 @@ def submit_task():
         if not isinstance(delay, (int, float)) or delay < 0:
             return jsonify({'error': 'delay must be a non-negative number'}), 400
             
+        if admission:
+            decision = admission.check(priority)
+            if not decision['admitted']:
+                app.logger.warning(f"Rejecting task: type={task_type}, priority={priority}: {decision['reason']}")
+                return jsonify({
+                    'error': decision['reason'],
+                    'expected_wait': decision['expected_wait'],
+                    'retry_after': decision['retry_after']
+                }), decision['status'], {'Retry-After': str(decision['retry_after'])}
+            
         app.logger.info(f"Submitting task: type={task_type}, priority={priority}, parameters={parameters}, delay={delay}")
         
         # Submit task with priority-based routing
@@ -63,6 +82,9 @@ def submit_task():
             delay=delay
         )
         
+        if admission:
+            admission.record_admitted(decision['queue'])
+        
         app.logger.info(f"Task submitted successfully: {task.id}")
         return jsonify({
             'task_id': task.id,
@@ -74,6 +96,39 @@ def submit_task():
         app.logger.error(f"Error submitting task: {str(e)}\n{traceback.format_exc()}")
         return jsonify({'error': str(e)}), 500
 
+def list_tasks():
+    try:
+        limit = int(request.args.get('limit', 50))
+        offset = int(request.args.get('offset', 0))
+        since = parse_time(request.args.get('since'))
+        until = parse_time(request.args.get('until'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not 0 < limit <= celeryconfig.task_index_max_limit:
+        return jsonify({'error': f'limit must be between 1 and {celeryconfig.task_index_max_limit}'}), 400
+    if offset < 0:
+        return jsonify({'error': 'offset must be a non-negative number'}), 400
+
+    try:
+        result = search_tasks(
+            state=request.args.get('state'),
+            task_type=request.args.get('type'),
+            priority=request.args.get('priority'),
+            since=since,
+            until=until,
+            limit=limit,
+            offset=offset
+        )
+    except TaskError as e:
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        logger.error(f"Error searching tasks: {str(e)}\n{traceback.format_exc()}")
+        return jsonify({'error': str(e)}), 500
+
+    if offset + len(result['tasks']) < result['total']:
+        result['next_offset'] = offset + len(result['tasks'])
+    return jsonify(result), 200
+
 @app.route('/api/tasks/<task_id>', methods=['GET', 'OPTIONS'])
 def get_task(task_id):
     if request.method == 'OPTIONS':
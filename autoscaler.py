@@ -0,0 +1,452 @@
+"""Queue-depth-driven autoscaler for the worker pools.
+
+Each pool is a group of queues served by one kind of worker (the services in
+docker-compose.yml, configured as ``autoscaler_pools`` in celeryconfig.py).
+Every interval the controller samples queue depths from the broker and worker
+utilization through Celery's inspect API, predicts how long the backlog will
+take to drain and decides a target concurrency per pool. Decisions are either
+applied in-process with ``pool_grow``/``pool_shrink`` or emitted as desired
+replica counts (JSON lines) for an external orchestrator.
+
+Usage:
+    python autoscaler.py run --mode emit --output desired.jsonl
+    python autoscaler.py run --mode pool
+    python autoscaler.py simulate --profile burst --trace
+"""
+import argparse
+import json
+import logging
+import math
+import random
+import sys
+import time
+
+import celeryconfig
+import sharding
+from queue_metrics import RateTracker, get_queue_depths
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+
+class ScalingPolicy:
+    """Turns a pool sample into a target concurrency.
+
+    Scaling up happens when the predicted drain time exceeds the target or the
+    pool is saturated; scaling down only when the backlog drains in well under
+    the target and utilization has been low for ``scale_down_samples``
+    consecutive samples. A scale down keeps enough slots for the busiest of
+    those samples to stay ``scale_down_margin`` below ``scale_up_utilization``.
+    Between the two bands the concurrency is held, and separate cooldowns stop
+    the controller from flapping.
+    """
+
+    def __init__(self, min_concurrency=1, max_concurrency=8, target_drain_seconds=30.0,
+                 scale_up_utilization=0.8, scale_down_utilization=0.3,
+                 scale_down_drain_ratio=0.5, scale_up_cooldown=30.0,
+                 scale_down_cooldown=120.0, max_step=4, default_task_rate=1.0,
+                 scale_down_samples=3, scale_down_margin=0.2):
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.target_drain_seconds = target_drain_seconds
+        self.scale_up_utilization = scale_up_utilization
+        self.scale_down_utilization = scale_down_utilization
+        self.scale_down_drain_ratio = scale_down_drain_ratio
+        self.scale_up_cooldown = scale_up_cooldown
+        self.scale_down_cooldown = scale_down_cooldown
+        self.max_step = max_step
+        self.default_task_rate = default_task_rate
+        self.scale_down_samples = scale_down_samples
+        self.scale_down_margin = scale_down_margin
+        self.last_change = {}
+        # Busy slot counts of the consecutive low samples seen per pool
+        self.low_samples = {}
+
+    @classmethod
+    def from_config(cls, config=celeryconfig):
+        return cls(
+            min_concurrency=config.autoscaler_min_concurrency,
+            max_concurrency=config.autoscaler_max_concurrency,
+            target_drain_seconds=config.autoscaler_target_drain_seconds,
+            scale_up_utilization=config.autoscaler_scale_up_utilization,
+            scale_down_utilization=config.autoscaler_scale_down_utilization,
+            scale_up_cooldown=config.autoscaler_scale_up_cooldown,
+            scale_down_cooldown=config.autoscaler_scale_down_cooldown,
+            max_step=config.autoscaler_max_step,
+            scale_down_samples=config.autoscaler_scale_down_samples,
+            scale_down_margin=config.autoscaler_scale_down_margin,
+        )
+
+    def slot_rate(self, sample, concurrency):
+        """Tasks per second a single busy slot completes."""
+        completed_rate = sample.get('completed_rate') or 0.0
+        if completed_rate > 0:
+            return completed_rate / max(sample.get('busy') or concurrency, 1)
+        return self.default_task_rate
+
+    def predict_drain_time(self, sample, concurrency):
+        if not sample['depth']:
+            return 0.0
+        rate = self.slot_rate(sample, concurrency) * concurrency
+        return sample['depth'] / rate if rate > 0 else math.inf
+
+    def decide(self, pool, sample, current, now=None):
+        """Return a decision dict with the desired concurrency for pool."""
+        now = time.monotonic() if now is None else now
+        slot_rate = self.slot_rate(sample, current)
+        drain_time = self.predict_drain_time(sample, current)
+        if current:
+            utilization = sample['busy'] / current
+        else:
+            utilization = 1.0 if sample['depth'] else 0.0
+        needed = math.ceil(sample['depth'] / (slot_rate * self.target_drain_seconds))
+        since_change = now - self.last_change.get(pool, -math.inf)
+
+        low = (drain_time < self.target_drain_seconds * self.scale_down_drain_ratio
+               and utilization <= self.scale_down_utilization
+               and current > self.min_concurrency)
+        if low:
+            low_samples = self.low_samples.setdefault(pool, [])
+            low_samples.append(sample['busy'])
+            del low_samples[:-self.scale_down_samples]
+        else:
+            self.low_samples.pop(pool, None)
+
+        desired, reason = current, 'hold'
+        if current < self.min_concurrency:
+            desired, reason = self.min_concurrency, 'below minimum'
+        elif current > self.max_concurrency:
+            desired, reason = self.max_concurrency, 'above maximum'
+        elif drain_time > self.target_drain_seconds or utilization >= self.scale_up_utilization:
+            if current >= self.max_concurrency:
+                reason = 'at maximum'
+            elif since_change < self.scale_up_cooldown:
+                reason = 'scale up cooldown'
+            else:
+                desired = min(max(needed, current + 1), current + self.max_step, self.max_concurrency)
+                reason = 'drain time' if drain_time > self.target_drain_seconds else 'utilization'
+        elif low:
+            if since_change < self.scale_down_cooldown:
+                reason = 'scale down cooldown'
+            elif len(self.low_samples[pool]) < self.scale_down_samples:
+                reason = 'low utilization'
+            else:
+                # Size for the busiest recent sample with headroom below the scale up threshold
+                busy = max(self.low_samples[pool])
+                target_utilization = max(self.scale_up_utilization - self.scale_down_margin, 0.1)
+                floor = max(needed, math.ceil(busy / target_utilization),
+                            self.min_concurrency, current - self.max_step)
+                if floor < current:
+                    desired, reason = floor, 'idle'
+
+        if desired != current:
+            self.last_change[pool] = now
+            self.low_samples.pop(pool, None)
+        return {
+            'pool': pool,
+            'current': current,
+            'desired': desired,
+            'depth': sample['depth'],
+            'drain_time': drain_time,
+            'utilization': utilization,
+            'reason': reason,
+        }
+
+
+class ClusterSampler:
+    """Samples queue depths and worker utilization for each pool."""
+
+    def __init__(self, app, pools, timeout=1.0):
+        self.app = app
+        self.pools = pools
+        self.timeout = timeout
+        self.completed = RateTracker()
+
+    def sample_workers(self):
+        # With sharded brokers each worker only listens for control commands on its own shard
+        workers = {}
+        for url in sharding.broker_urls():
+            with sharding.broker_connection(self.app, url) as conn:
+                inspect = self.app.control.inspect(timeout=self.timeout, connection=conn)
+                active_queues = inspect.active_queues() or {}
+                stats = inspect.stats() or {}
+                active = inspect.active() or {}
+
+            for name, queues in active_queues.items():
+                worker_stats = stats.get(name, {})
+                processed = sum(worker_stats.get('total', {}).values())
+                workers[name] = {
+                    'queues': {queue['name'] for queue in queues},
+                    'capacity': worker_stats.get('pool', {}).get('max-concurrency', 1),
+                    'busy': len(active.get(name, [])),
+                    'completed_rate': self.completed.update(name, processed) or 0.0,
+                    'broker': url,
+                    'pool': pool_name(worker_stats.get('pool', {}).get('implementation')),
+                }
+        return workers
+
+    def sample(self):
+        queue_names = sorted({queue for queues in self.pools.values() for queue in queues})
+        depths = get_queue_depths(self.app, queue_names)
+        workers = self.sample_workers()
+
+        # A worker serving several pools has its throughput split between them
+        served_pools = {
+            name: sum(1 for queues in self.pools.values() if info['queues'] & set(queues)) or 1
+            for name, info in workers.items()
+        }
+
+        samples = {}
+        for pool, queues in self.pools.items():
+            members = [name for name, info in workers.items() if info['queues'] & set(queues)]
+            samples[pool] = {
+                'depth': sum(depths[queue]['messages'] for queue in queues),
+                'queues': {queue: depths[queue]['messages'] for queue in queues},
+                'workers': members,
+                'brokers': {name: workers[name]['broker'] for name in members},
+                'pool_types': {name: workers[name]['pool'] for name in members},
+                'concurrency': sum(workers[name]['capacity'] for name in members),
+                'busy': sum(workers[name]['busy'] for name in members),
+                'completed_rate': sum(
+                    workers[name]['completed_rate'] / served_pools[name] for name in members
+                ),
+            }
+        return samples
+
+
+# Worker pools that support pool_grow/pool_shrink; solo and threads have a fixed size
+RESIZABLE_POOLS = ('prefork', 'eventlet', 'gevent')
+
+
+def pool_name(implementation):
+    """Short pool name from the 'celery.concurrency.prefork:TaskPool' path in worker stats."""
+    if not implementation:
+        return None
+    return implementation.partition(':')[0].rpartition('.')[2]
+
+
+class Autoscaler:
+    """Periodically samples the cluster and applies or emits scaling decisions."""
+
+    def __init__(self, app, pools, policy, mode='emit', slots_per_replica=1, output=None):
+        if mode not in ('emit', 'pool'):
+            raise ValueError(f"Unknown autoscaler mode: {mode}")
+        self.app = app
+        self.pools = pools
+        self.policy = policy
+        self.mode = mode
+        self.slots_per_replica = slots_per_replica
+        self.output = output or sys.stdout
+        self.sampler = ClusterSampler(app, pools)
+
+    def step(self, now=None):
+        samples = self.sampler.sample()
+        decisions = []
+        for pool, sample in samples.items():
+            decision = self.policy.decide(pool, sample, sample['concurrency'], now)
+            decisions.append(decision)
+            if decision['desired'] != decision['current']:
+                logger.info(
+                    f"Pool {pool}: {decision['current']} -> {decision['desired']} "
+                    f"({decision['reason']}, depth={decision['depth']}, "
+                    f"drain={decision['drain_time']:.1f}s, util={decision['utilization']:.2f})"
+                )
+                if self.mode == 'pool':
+                    self.resize_pool(sample, decision['desired'])
+            if self.mode == 'emit':
+                self.emit(decision)
+        return decisions
+
+    def resize_pool(self, sample, desired):
+        """Spread the change in concurrency across the pool's resizable workers."""
+        workers = [name for name in sample['workers'] if sample['pool_types'].get(name) in RESIZABLE_POOLS]
+        fixed = sorted(set(sample['workers']) - set(workers))
+        for name in fixed:
+            logger.warning(f"Skipping {name}: its {sample['pool_types'].get(name)} pool cannot be resized")
+        if not workers:
+            logger.warning("No running workers to resize; use --mode emit to scale replicas")
+            return
+        delta = desired - sample['concurrency']
+        share, extra = divmod(abs(delta), len(workers))
+        for index, worker in enumerate(workers):
+            n = share + (1 if index < extra else 0)
+            if not n:
+                continue
+            with sharding.broker_connection(self.app, sample['brokers'].get(worker)) as conn:
+                if delta > 0:
+                    self.app.control.pool_grow(n, destination=[worker], connection=conn)
+                else:
+                    self.app.control.pool_shrink(n, destination=[worker], connection=conn)
+
+    def emit(self, decision):
+        record = dict(decision)
+        record['replicas'] = math.ceil(decision['desired'] / self.slots_per_replica)
+        record['drain_time'] = None if math.isinf(decision['drain_time']) else decision['drain_time']
+        record['time'] = time.time()
+        self.output.write(json.dumps(record) + '\n')
+        self.output.flush()
+
+    def run(self, interval):
+        logger.info(f"Autoscaler running in {self.mode} mode for pools: {', '.join(self.pools)}")
+        while True:
+            try:
+                self.step()
+            except Exception as e:
+                logger.error(f"Autoscaler step failed: {str(e)}")
+            time.sleep(interval)
+
+
+def _poisson(rng, lam):
+    """Number of events in one interval of a Poisson process with mean lam."""
+    count, elapsed = 0, rng.expovariate(1.0)
+    while elapsed < lam:
+        count += 1
+        elapsed += rng.expovariate(1.0)
+    return count
+
+
+SIMULATION_PROFILES = {
+    'steady': lambda t: 2.0,
+    'burst': lambda t: 12.0 if 120 <= t < 240 else 1.0,
+    'ramp': lambda t: min(0.02 * t, 10.0),
+    'diurnal': lambda t: 5.0 + 4.0 * math.sin(2 * math.pi * t / 600.0),
+}
+
+
+def simulate(policy, profile, duration=600.0, tick=1.0, service_time=1.0,
+             sample_interval=10.0, startup_delay=5.0, initial=1, seed=42, trace=None):
+    """Run the policy against a synthetic queue and return summary statistics.
+
+    Arrivals follow ``profile(t)`` tasks per second, each slot completes one
+    task every ``service_time`` seconds and new capacity only becomes
+    available ``startup_delay`` seconds after a scale-up decision.
+    """
+    rng = random.Random(seed)
+    arrival_rate = SIMULATION_PROFILES[profile] if isinstance(profile, str) else profile
+    depth, concurrency, credit = 0, initial, 0.0
+    pending = []
+    completed = 0
+    events = 0
+    depth_sum = concurrency_sum = max_depth = 0
+    interval_served = interval_start = 0
+
+    steps = int(duration / tick)
+    for i in range(steps):
+        now = i * tick
+        for ready_at, target in list(pending):
+            if ready_at <= now:
+                concurrency = target
+                pending.remove((ready_at, target))
+
+        depth += _poisson(rng, arrival_rate(now) * tick)
+        credit += concurrency * tick / service_time
+        served = min(depth, int(credit))
+        credit = min(credit - served, float(concurrency))
+        depth -= served
+        completed += served
+        interval_served += served
+
+        if i % max(int(sample_interval / tick), 1) == 0:
+            # Like the live sampler, report averages over the sample interval
+            window = max(now - interval_start, tick)
+            sample = {
+                'depth': depth,
+                'busy': min(concurrency, interval_served * service_time / window),
+                'completed_rate': interval_served / window,
+            }
+            interval_served, interval_start = 0, now
+            decision = policy.decide('simulation', sample, concurrency, now)
+            if decision['desired'] > concurrency:
+                pending.append((now + startup_delay, decision['desired']))
+                events += 1
+            elif decision['desired'] < concurrency:
+                concurrency = decision['desired']
+                events += 1
+            if trace:
+                trace.write(json.dumps(dict(decision, time=now, arrival_rate=arrival_rate(now))) + '\n')
+
+        depth_sum += depth
+        concurrency_sum += concurrency
+        max_depth = max(max_depth, depth)
+
+    return {
+        'profile': profile if isinstance(profile, str) else 'custom',
+        'duration': duration,
+        'completed': completed,
+        'final_depth': depth,
+        'max_depth': max_depth,
+        'mean_depth': depth_sum / steps if steps else 0,
+        'mean_concurrency': concurrency_sum / steps if steps else 0,
+        'slot_seconds': concurrency_sum * tick,
+        'scaling_events': events,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Queue-depth-driven worker autoscaler')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Control a live cluster')
+    run_parser.add_argument('--mode', choices=('emit', 'pool'), default='emit',
+                            help='emit desired replica counts or resize worker pools in place')
+    run_parser.add_argument('--interval', type=float, default=celeryconfig.autoscaler_interval)
+    run_parser.add_argument('--output', help='Append emitted decisions to this file (default stdout)')
+
+    sim_parser = subparsers.add_parser('simulate', help='Evaluate the policy offline')
+    sim_parser.add_argument('--profile', choices=sorted(SIMULATION_PROFILES), default='burst')
+    sim_parser.add_argument('--duration', type=float, default=600.0)
+    sim_parser.add_argument('--service-time', type=float, default=1.0)
+    sim_parser.add_argument('--startup-delay', type=float, default=5.0)
+    sim_parser.add_argument('--sample-interval', type=float, default=celeryconfig.autoscaler_interval)
+    sim_parser.add_argument('--seed', type=int, default=42)
+    sim_parser.add_argument('--trace', action='store_true', help='Print every decision as JSON')
+
+    args = parser.parse_args(argv)
+    policy = ScalingPolicy.from_config()
+
+    if args.command == 'simulate':
+        summary = simulate(
+            policy,
+            args.profile,
+            duration=args.duration,
+            service_time=args.service_time,
+            sample_interval=args.sample_interval,
+            startup_delay=args.startup_delay,
+            initial=policy.min_concurrency,
+            seed=args.seed,
+            trace=sys.stdout if args.trace else None,
+        )
+        print(json.dumps(summary, indent=2))
+        return 0
+
+    from tasks import celery_app
+
+    output = open(args.output, 'a') if args.output else None
+    try:
+        autoscaler = Autoscaler(
+            celery_app,
+            celeryconfig.autoscaler_pools,
+            policy,
+            mode=args.mode,
+            slots_per_replica=celeryconfig.autoscaler_slots_per_replica,
+            output=output,
+        )
+    except ValueError as e:
+        if output:
+            output.close()
+        parser.error(str(e))
+    try:
+        autoscaler.run(args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if output:
+            output.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
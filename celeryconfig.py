@@ -49,6 +49,8 @@ task_routes.update({
     'tasks.process_data_task': {'queue': 'data_processing', 'routing_key': 'data_processing'},
     'tasks.send_email_task': {'queue': 'email_sending', 'routing_key': 'email_sending'},
     'tasks.process_file_task': {'queue': 'file_processing', 'routing_key': 'file_processing'},
+    'tasks.process_file_range': {'queue': 'file_processing', 'routing_key': 'file_processing'},
+    'tasks.merge_file_results': {'queue': 'file_processing', 'routing_key': 'file_processing'},
 })
 
 # Configure task retry policy
@@ -77,4 +79,97 @@ broker_connection_timeout = 30
 
 task_track_started = True
 task_ignore_result = False
-task_store_errors_even_if_ignored = True 
\ No newline at end of file
+task_store_errors_even_if_ignored = True 
+
+# Autoscaler (see autoscaler.py). Pools mirror the worker services in docker-compose.yml
+autoscaler_pools = {
+    'worker': ['default', 'high_priority', 'low_priority'],
+    'data_worker': ['data_processing'],
+    'email_worker': ['email_sending'],
+    'file_worker': ['file_processing'],
+}
+autoscaler_interval = float(os.getenv('AUTOSCALER_INTERVAL', '10')) # Seconds between samples
+autoscaler_min_concurrency = int(os.getenv('AUTOSCALER_MIN_CONCURRENCY', '1'))
+autoscaler_max_concurrency = int(os.getenv('AUTOSCALER_MAX_CONCURRENCY', '8'))
+autoscaler_target_drain_seconds = 30 # Scale up when the backlog takes longer than this to drain
+autoscaler_scale_up_utilization = 0.8 # Busy fraction of slots that triggers a scale up
+autoscaler_scale_down_utilization = 0.3 # Busy fraction of slots below which we may scale down
+autoscaler_scale_up_cooldown = 30 # Seconds after a change before scaling up again
+autoscaler_scale_down_cooldown = 120 # Seconds after a change before scaling down again
+autoscaler_max_step = 4 # Maximum change in concurrency per decision
+autoscaler_scale_down_samples = 3 # Consecutive low samples required before scaling down
+autoscaler_scale_down_margin = 0.2 # Utilization headroom below the scale up threshold kept after scaling down
+autoscaler_slots_per_replica = worker_concurrency # Used to turn concurrency into replica counts
+
+# Admission control at the API (see admission.py)
+admission_control_enabled = os.getenv('ADMISSION_CONTROL', 'true').lower() == 'true'
+admission_slo_seconds = { # Maximum expected queue wait per priority, None never sheds
+    'high': None,
+    'normal': int(os.getenv('ADMISSION_NORMAL_SLO', '120')),
+    'low': int(os.getenv('ADMISSION_LOW_SLO', '30')),
+}
+admission_max_queue_depth = int(os.getenv('ADMISSION_MAX_QUEUE_DEPTH', '10000')) # Hard cap for classes with an SLO
+admission_cache_ttl = 1.0 # Seconds a queue depth sample is reused
+admission_default_drain_rate = 1.0 # Tasks per second assumed before a drain rate is observed
+
+task_progress_max_updates_per_second = 2 # Per task cap on PROGRESS writes to the result backend
+
+# File processing pipeline (see file_pipeline.py)
+file_data_root = os.getenv('FILE_DATA_ROOT', '/data') # File tasks only read and write paths under this directory
+file_chunk_size = 1024 * 1024 # Bytes read per chunk
+file_max_line_bytes = int(os.getenv('FILE_MAX_LINE_BYTES', str(64 * 1024 * 1024))) # Longer lines fail the task instead of growing memory
+file_split_threshold = int(os.getenv('FILE_SPLIT_THRESHOLD', str(256 * 1024 * 1024))) # Files above this are split into subtasks
+file_split_part_size = int(os.getenv('FILE_SPLIT_PART_SIZE', str(128 * 1024 * 1024))) # Target bytes per subtask
+file_max_chunk_size = int(os.getenv('FILE_MAX_CHUNK_SIZE', str(64 * 1024 * 1024))) # Largest chunk_size a task may ask for
+file_min_part_size = int(os.getenv('FILE_MIN_PART_SIZE', str(1024 * 1024))) # Requested parts are reduced so each covers at least this many bytes
+file_max_parts = int(os.getenv('FILE_MAX_PARTS', '64')) # Upper bound on subtasks per file
+
+# Columnar data engine (see data_engine.py)
+data_batch_size = 1000000 # Rows per batch
+data_max_output_rows = 10000 # Rows returned when there is no aggregation
+data_partial_max_groups = 100 # Stream partial results only while the group count is small
+
+# Email delivery (see email_delivery.py). Run `python email_delivery.py` for a local debugging relay
+email_delivery_enabled = os.getenv('EMAIL_DELIVERY', 'false').lower() == 'true' # Simulate sends when disabled
+email_default_relay = os.getenv('SMTP_RELAY', 'localhost:1025')
+email_domain_relays = {} # Per recipient domain relay overrides, e.g. {'example.com': 'smtp.example.com:587'}
+email_from = os.getenv('EMAIL_FROM', 'noreply@localhost')
+email_use_tls = os.getenv('SMTP_USE_TLS', 'false').lower() == 'true'
+email_username = os.getenv('SMTP_USERNAME')
+email_password = os.getenv('SMTP_PASSWORD')
+email_pool_size = int(os.getenv('SMTP_POOL_SIZE', '4')) # Persistent sessions per relay per worker process
+email_idle_timeout = 60 # Seconds before an idle session is replaced instead of reused
+email_max_messages_per_connection = 1000 # Recycle a session after this many messages
+email_max_recipients_per_envelope = 100
+
+# Worker resource cache
+worker_resource_max_bytes = int(os.getenv('WORKER_RESOURCE_MAX_BYTES', str(worker_max_memory_per_child * 1024 // 2))) # Per process, half the recycle limit
+worker_resource_stats_interval = 10 # Seconds between a pool child's published cache snapshots
+
+# Task search index
+task_index_enabled = os.getenv('TASK_INDEX', 'true').lower() == 'true'
+task_index_retention_seconds = int(os.getenv('TASK_INDEX_RETENTION', str(7 * 24 * 3600))) # How long finished tasks stay searchable
+task_index_max_limit = 500 # Largest page GET /api/tasks returns
+
+# Sharding, comma separated URLs; queues and result keys are placed on a consistent hash ring
+broker_shards = [url for url in os.getenv('BROKER_SHARDS', '').split(',') if url]
+result_backend_shards = [url for url in os.getenv('RESULT_BACKEND_SHARDS', '').split(',') if url]
+shard_virtual_nodes = 160 # Ring points per shard, more evens out the load
+if result_backend_shards:
+    # The base instance keeps pub/sub, chord counters and the task index
+    result_backend = f"sharding:ShardedRedisBackend+{result_backend}"
+
+# Queue backend: 'rabbitmq' (RabbitMQ broker, Redis results) or 'embedded' (one SQLite file, single node only)
+queue_backend = os.getenv('QUEUE_BACKEND', 'rabbitmq')
+embedded_queue_path = os.getenv('EMBEDDED_QUEUE_PATH', 'task_queue.db')
+if queue_backend == 'embedded':
+    broker_url = 'embedded://'
+    result_backend = 'embedded_queue:SQLiteBackend'
+    broker_transport_options = {
+        'path': embedded_queue_path,
+        'visibility_timeout': task_time_limit + 600, # Redeliver tasks of a dead worker, longer than any task runs
+        'polling_interval': 0.05,
+    }
+    # A single node has nothing to shard
+    broker_shards = []
+    result_backend_shards = []
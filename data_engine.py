@@ -0,0 +1,340 @@
+"""Vectorized columnar engine for data_processing tasks.
+
+Input is a set of equally long columns, either inline as JSON lists, an
+``.npz`` file of NumPy arrays, or an Arrow IPC/Feather/Parquet file when
+pyarrow is installed. Rows are processed in batches through a declarative
+list of operations, each implemented with NumPy kernels:
+
+    [
+        {'op': 'filter', 'column': 'amount', 'cmp': '>', 'value': 100},
+        {'op': 'project', 'columns': ['region', 'amount']},
+        {'op': 'group_by', 'keys': ['region'], 'aggs': {'total': ['amount', 'sum'], 'n': ['*', 'count']}}
+    ]
+
+``filter`` and ``project`` may appear any number of times; ``aggregate`` and
+``group_by`` are terminal and must come last. Aggregations are kept as
+mergeable partial states per batch, so partial results can be streamed while
+the input is still being read.
+"""
+import os
+
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+DEFAULT_BATCH_SIZE = 1000000
+
+COMPARATORS = {
+    '==': np.equal,
+    '!=': np.not_equal,
+    '<': np.less,
+    '<=': np.less_equal,
+    '>': np.greater,
+    '>=': np.greater_equal,
+    'in': lambda column, value: np.isin(column, value),
+    'not_in': lambda column, value: ~np.isin(column, value),
+}
+
+# Partial state kinds and the ufunc that merges two partials of that kind
+STATE_MERGE = {
+    'sum': np.add,
+    'count': np.add,
+    'min': np.minimum,
+    'max': np.maximum,
+}
+
+AGGREGATES = ('sum', 'count', 'min', 'max', 'mean')
+
+
+class DataEngineError(Exception):
+    pass
+
+
+def _arrow_to_numpy(record_batch):
+    return {
+        name: column.to_numpy(zero_copy_only=False)
+        for name, column in zip(record_batch.schema.names, record_batch.columns)
+    }
+
+
+def iter_batches(columns=None, path=None, batch_size=DEFAULT_BATCH_SIZE):
+    """Yield dicts of equally long NumPy arrays of at most batch_size rows."""
+    if path is not None:
+        extension = os.path.splitext(path)[1].lower()
+        if extension == '.npz':
+            with np.load(path, allow_pickle=False) as data:
+                columns = {name: data[name] for name in data.files}
+        elif extension in ('.arrow', '.feather', '.ipc', '.parquet'):
+            if pyarrow is None:
+                raise DataEngineError(f"pyarrow is required to read {extension} files")
+            if extension == '.parquet':
+                for record_batch in pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=batch_size):
+                    yield _arrow_to_numpy(record_batch)
+                return
+            with pyarrow.memory_map(path) as source:
+                reader = pyarrow.ipc.open_file(source)
+                for index in range(reader.num_record_batches):
+                    table = pyarrow.Table.from_batches([reader.get_batch(index)])
+                    for record_batch in table.to_batches(max_chunksize=batch_size):
+                        yield _arrow_to_numpy(record_batch)
+            return
+        else:
+            raise DataEngineError(f"Unsupported input format: {path}")
+
+    if not columns:
+        raise DataEngineError("No input columns")
+    arrays = {name: np.asarray(values) for name, values in columns.items()}
+    lengths = {len(array) for array in arrays.values()}
+    if len(lengths) != 1:
+        raise DataEngineError("All columns must have the same length")
+    rows = lengths.pop()
+    for start in range(0, rows, batch_size):
+        yield {name: array[start:start + batch_size] for name, array in arrays.items()}
+
+
+def count_rows(columns=None, path=None):
+    """Number of input rows if it is cheap to know up front, else None."""
+    if columns:
+        return len(next(iter(columns.values())))
+    if path and path.endswith('.parquet') and pyarrow is not None:
+        return pyarrow.parquet.ParquetFile(path).metadata.num_rows
+    return None
+
+
+def factorize(values):
+    """Return (uniques, codes) such that uniques[codes] == values, uniques sorted.
+
+    Integer keys with a compact range are factorized in linear time with
+    bincount; everything else falls back to a sort through np.unique.
+    """
+    if values.dtype.kind in 'biu' and len(values):
+        # Bools count as 0/1, but uniques keep the original dtype
+        numbers = values.astype(np.uint8) if values.dtype.kind == 'b' else values
+        low = int(numbers.min())
+        span = int(numbers.max()) - low + 1
+        if span <= max(2 * len(values), 1024):
+            offsets = (numbers - low).astype(np.intp)
+            present = np.bincount(offsets, minlength=span) > 0
+            remap = np.cumsum(present) - 1
+            return (np.flatnonzero(present) + low).astype(values.dtype), remap[offsets]
+    uniques, codes = np.unique(values, return_inverse=True)
+    return uniques, codes.reshape(-1)
+
+
+def reduce_groups(keys, states):
+    """Reduce state columns by the distinct combinations of the key columns.
+
+    keys is a list of arrays, states maps (kind, column) to an array of the
+    same length. Returns the distinct keys (in sorted order) and the reduced
+    states; with no keys everything collapses to a single group.
+    """
+    rows = len(next(iter(states.values())))
+    if not rows:
+        return [key[:0] for key in keys], {state: values[:0] for state, values in states.items()}
+
+    if keys:
+        # Combine the keys one at a time, re-factorizing so codes stay below the row count
+        group_keys, codes = factorize(keys[0])
+        group_keys = [group_keys]
+        for key in keys[1:]:
+            uniques, key_codes = factorize(key)
+            combined, codes = factorize(codes.astype(np.int64) * len(uniques) + key_codes)
+            previous, current = np.divmod(combined, len(uniques))
+            group_keys = [values[previous] for values in group_keys] + [uniques[current]]
+        groups = len(group_keys[0])
+    else:
+        group_keys, codes, groups = [], np.zeros(rows, dtype=np.intp), 1
+
+    reduced = {}
+    for state, values in states.items():
+        kind = state[0]
+        if kind in ('sum', 'count'):
+            out = np.zeros(groups, dtype=values.dtype)
+        elif values.dtype.kind not in 'biuf':
+            # No min/max loops for strings and the like, reduce their sorted codes instead
+            uniques, value_codes = factorize(values)
+            out = np.zeros(groups, dtype=np.intp) if kind == 'max' else np.full(groups, len(uniques) - 1)
+            STATE_MERGE[kind].at(out, codes, value_codes)
+            reduced[state] = uniques[out]
+            continue
+        else:
+            # Seed min/max with each group's first value
+            first = np.full(groups, rows, dtype=np.intp)
+            np.minimum.at(first, codes, np.arange(rows))
+            out = values[first].copy()
+        STATE_MERGE[kind].at(out, codes, values)
+        reduced[state] = out
+    return group_keys, reduced
+
+
+class DataEngine:
+    """Applies a list of operations to a stream of column batches."""
+
+    def __init__(self, operations, max_output_rows=10000):
+        self.row_ops = []
+        self.keys = None
+        self.aggs = None
+        self.max_output_rows = max_output_rows
+        self.rows_in = 0
+        self.rows_matched = 0
+        self.output = []
+        self.group_keys = None
+        self.group_states = None
+
+        for index, operation in enumerate(operations or []):
+            op = operation.get('op')
+            if op in ('filter', 'project'):
+                if self.aggs is not None:
+                    raise DataEngineError(f"{op} cannot follow an aggregation")
+                self.row_ops.append(operation)
+            elif op in ('aggregate', 'group_by'):
+                if index != len(operations) - 1:
+                    raise DataEngineError(f"{op} must be the last operation")
+                self.keys = list(operation.get('keys', [])) if op == 'group_by' else []
+                self.aggs = self._parse_aggs(operation.get('aggs'))
+            else:
+                raise DataEngineError(f"Unknown operation: {op}")
+
+    @staticmethod
+    def _parse_aggs(aggs):
+        if not aggs:
+            raise DataEngineError("aggs is required for aggregations")
+        parsed = {}
+        for name, spec in aggs.items():
+            column, func = spec
+            if func not in AGGREGATES:
+                raise DataEngineError(f"Unknown aggregate function: {func}")
+            parsed[name] = (column, func)
+        return parsed
+
+    def _states_for(self, batch):
+        """Per-row partial states needed by the configured aggregates."""
+        rows = len(next(iter(batch.values()))) if batch else 0
+        missing = [column for column, func in self.aggs.values() if func != 'count' and column not in batch]
+        missing += [key for key in self.keys if key not in batch]
+        if missing:
+            raise DataEngineError(f"Unknown columns: {missing}")
+        states = {}
+        for column, func in self.aggs.values():
+            if func in ('count', 'mean'):
+                states[('count', '*')] = np.ones(rows, dtype=np.int64)
+            if func in ('sum', 'mean'):
+                values = batch[column]
+                # Sum small integers and booleans in 64 bits to avoid overflow
+                if values.dtype.kind in 'biu':
+                    values = values.astype(np.int64)
+                states[('sum', column)] = values
+            elif func in ('min', 'max'):
+                states[(func, column)] = batch[column]
+        return states
+
+    def _apply_row_ops(self, batch):
+        for operation in self.row_ops:
+            if operation['op'] == 'filter':
+                column = operation['column']
+                if column not in batch:
+                    raise DataEngineError(f"Unknown column: {column}")
+                cmp = operation.get('cmp', '==')
+                if cmp not in COMPARATORS:
+                    raise DataEngineError(f"Unknown comparison: {cmp}")
+                mask = COMPARATORS[cmp](batch[column], operation.get('value'))
+                batch = {name: values[mask] for name, values in batch.items()}
+            else:
+                missing = [name for name in operation['columns'] if name not in batch]
+                if missing:
+                    raise DataEngineError(f"Unknown columns: {missing}")
+                batch = {name: batch[name] for name in operation['columns']}
+        return batch
+
+    def process_batch(self, batch):
+        self.rows_in += len(next(iter(batch.values())))
+        batch = self._apply_row_ops(batch)
+        matched = len(next(iter(batch.values()))) if batch else 0
+        self.rows_matched += matched
+
+        if self.aggs is None:
+            kept = sum(len(next(iter(part.values()))) for part in self.output)
+            if matched and kept < self.max_output_rows:
+                self.output.append({
+                    name: values[:self.max_output_rows - kept] for name, values in batch.items()
+                })
+            return
+
+        if not matched:
+            return
+        keys, states = reduce_groups([batch[key] for key in self.keys], self._states_for(batch))
+        if self.group_states is not None:
+            # Merge with what we have so far by reducing the partials again
+            keys = [np.concatenate([old, new]) for old, new in zip(self.group_keys, keys)]
+            states = {
+                state: np.concatenate([self.group_states[state], values])
+                for state, values in states.items()
+            }
+            keys, states = reduce_groups(keys, states)
+        self.group_keys, self.group_states = keys, states
+
+    def partial(self, max_groups):
+        """Aggregation result so far, or None if there are more than max_groups groups."""
+        if self.aggs is None:
+            return None
+        if self.keys and self.group_keys is not None and len(self.group_keys[0]) > max_groups:
+            return None
+        return self.result()
+
+    def result(self):
+        summary = {'rows_in': self.rows_in, 'rows_matched': self.rows_matched}
+        if self.aggs is None:
+            columns = {}
+            if self.output:
+                columns = {
+                    name: np.concatenate([part[name] for part in self.output]).tolist()
+                    for name in self.output[0]
+                }
+            summary.update(columns=columns, truncated=self.rows_matched > self.max_output_rows)
+            return summary
+
+        states = self.group_states or {}
+        values = {}
+        for name, (column, func) in self.aggs.items():
+            if not states:
+                values[name] = [] if self.keys else (0 if func == 'count' else None)
+                continue
+            if func == 'mean':
+                result = states[('sum', column)] / states[('count', '*')]
+            elif func == 'count':
+                result = states[('count', '*')]
+            else:
+                result = states[(func, column)]
+            values[name] = result.tolist() if self.keys else result[0].item()
+
+        if not self.keys:
+            summary['values'] = values
+            return summary
+        groups = self.group_keys or [[] for _ in self.keys]
+        summary['groups'] = len(groups[0])
+        summary['columns'] = {
+            **{key: np.asarray(group).tolist() for key, group in zip(self.keys, groups)},
+            **values,
+        }
+        return summary
+
+
+def run(operations, columns=None, path=None, batch_size=DEFAULT_BATCH_SIZE,
+        max_output_rows=10000, on_batch=None):
+    """Run operations over the input and return the final result.
+
+    on_batch(engine, total_rows) is called after every batch so callers can
+    stream partial results; total_rows is None when it is not known upfront.
+    """
+    engine = DataEngine(operations, max_output_rows=max_output_rows)
+    total_rows = count_rows(columns, path)
+    for batch in iter_batches(columns, path, batch_size):
+        engine.process_batch(batch)
+        if on_batch:
+            on_batch(engine, total_rows)
+    return engine.result()
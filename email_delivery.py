@@ -0,0 +1,339 @@
+"""Email delivery over pooled, persistent SMTP connections.
+
+Each relay (host:port) gets a per-process pool of SMTP sessions, kept in the
+worker resource cache and reused across tasks, so a message costs one
+envelope instead of a TCP connect, greeting, EHLO and QUIT. Recipients are grouped by domain: every
+domain is sent one envelope per message (split at the envelope recipient
+limit) through its relay, and all envelopes for a relay go back to back over a
+single pooled session.
+
+For local development and tests run the debugging server, which accepts
+everything and logs what it receives:
+
+    python email_delivery.py --port 1025
+"""
+import argparse
+import logging
+import smtplib
+import socketserver
+import threading
+import time
+from contextlib import contextmanager
+from email.message import EmailMessage
+
+import celeryconfig
+from worker_resources import resources
+
+logger = logging.getLogger(__name__)
+
+
+class EmailDeliveryError(Exception):
+    """Delivery failed; `remaining` holds message specs for what was not delivered."""
+
+    def __init__(self, message, result=None, remaining=None):
+        super().__init__(message)
+        self.result = result or {}
+        self.remaining = remaining or []
+
+
+def parse_relay(relay):
+    host, _, port = relay.rpartition(':')
+    if not host:
+        return port, 25
+    return host, int(port)
+
+
+class SMTPConnectionPool:
+    """Thread-safe pool of persistent SMTP sessions to one relay."""
+
+    def __init__(self, host, port, max_size=4, idle_timeout=60.0, timeout=30.0,
+                 use_tls=False, username=None, password=None, max_messages_per_connection=1000):
+        self.host = host
+        self.port = port
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.use_tls = use_tls
+        self.username = username
+        self.password = password
+        self.max_messages_per_connection = max_messages_per_connection
+        self.condition = threading.Condition()
+        self.idle = []
+        self.size = 0
+        self.connections_opened = 0
+
+    def _connect(self):
+        conn = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        conn.ehlo()
+        if self.use_tls:
+            conn.starttls()
+            conn.ehlo()
+        if self.username:
+            conn.login(self.username, self.password)
+        conn.messages_sent = 0
+        conn.last_used = time.monotonic()
+        return conn
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.quit()
+        except (smtplib.SMTPException, OSError):
+            conn.close()
+
+    def _take(self):
+        with self.condition:
+            while True:
+                while self.idle:
+                    conn = self.idle.pop()
+                    if time.monotonic() - conn.last_used < self.idle_timeout:
+                        return conn
+                    # Relays drop idle sessions, do not bother reusing stale ones
+                    self.size -= 1
+                    self._close(conn)
+                if self.size < self.max_size:
+                    self.size += 1
+                    break
+                self.condition.wait()
+        try:
+            conn = self._connect()
+        except Exception:
+            with self.condition:
+                self.size -= 1
+                self.condition.notify()
+            raise
+        self.connections_opened += 1
+        return conn
+
+    def _give_back(self, conn, broken=False):
+        with self.condition:
+            if broken or conn.messages_sent >= self.max_messages_per_connection:
+                self.size -= 1
+                self._close(conn)
+            else:
+                conn.last_used = time.monotonic()
+                self.idle.append(conn)
+            self.condition.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self._take()
+        broken = False
+        try:
+            yield conn
+        except (smtplib.SMTPServerDisconnected, OSError):
+            broken = True
+            raise
+        finally:
+            self._give_back(conn, broken)
+
+    def send(self, envelopes, on_sent=None):
+        """Send (sender, recipients, message) envelopes over one pooled session.
+
+        Returns {recipient: (code, reason)} for refused recipients. A session
+        the relay dropped while idle is replaced once before giving up.
+        `on_sent` is called after each envelope the relay has accepted or
+        refused, so callers can tell how far a failed batch got.
+        """
+        refused = {}
+        pending = list(envelopes)
+        for attempt in range(2):
+            try:
+                with self.connection() as conn:
+                    while pending:
+                        sender, recipients, message = pending[0]
+                        try:
+                            refused.update(conn.send_message(message, sender, recipients))
+                        except smtplib.SMTPRecipientsRefused as e:
+                            refused.update(e.recipients)
+                        conn.messages_sent += 1
+                        pending.pop(0)
+                        if on_sent:
+                            on_sent(message)
+                return refused
+            except smtplib.SMTPServerDisconnected:
+                if attempt:
+                    raise
+        return refused
+
+    def close_all(self):
+        with self.condition:
+            for conn in self.idle:
+                self._close(conn)
+            self.size -= len(self.idle)
+            self.idle = []
+
+
+def get_pool(relay):
+    """Return this process's pool for relay ('host:port')."""
+    def build():
+        host, port = parse_relay(relay)
+        return SMTPConnectionPool(
+            host, port,
+            max_size=celeryconfig.email_pool_size,
+            idle_timeout=celeryconfig.email_idle_timeout,
+            use_tls=celeryconfig.email_use_tls,
+            username=celeryconfig.email_username,
+            password=celeryconfig.email_password,
+            max_messages_per_connection=celeryconfig.email_max_messages_per_connection,
+        )
+
+    # Pools live in the worker resource cache so they are closed with the process
+    return resources.get(f"smtp_pool:{relay}", factory=build, close=SMTPConnectionPool.close_all, size=0)
+
+
+def relay_for(domain):
+    return celeryconfig.email_domain_relays.get(domain, celeryconfig.email_default_relay)
+
+
+def build_message(spec):
+    recipients = spec.get('to')
+    if isinstance(recipients, str):
+        recipients = [recipients]
+    if not recipients:
+        raise EmailDeliveryError("Email needs at least one recipient")
+    message = EmailMessage()
+    message['From'] = spec.get('from') or celeryconfig.email_from
+    message['To'] = ', '.join(recipients)
+    message['Subject'] = spec.get('subject', '')
+    message.set_content(spec.get('body', ''))
+    return message['From'], recipients, message
+
+
+def deliver(specs, max_recipients=None):
+    """Deliver a batch of messages, grouping recipients by domain and relay.
+
+    If a relay fails, the other relays are still tried. EmailDeliveryError then
+    carries the counts so far and, as `remaining`, copies of the specs with
+    ``envelope_to`` narrowed to the recipients that were not reached.
+    """
+    max_recipients = max_recipients or celeryconfig.email_max_recipients_per_envelope
+    by_relay = {}
+    recipient_count = 0
+    for spec in specs:
+        sender, recipients, message = build_message(spec)
+        # A retried message only goes to the recipients it did not reach, the To header stays
+        recipients = spec.get('envelope_to') or recipients
+        recipient_count += len(recipients)
+        by_domain = {}
+        for recipient in recipients:
+            domain = recipient.rpartition('@')[2].lower()
+            by_domain.setdefault(domain, []).append(recipient)
+        for domain, domain_recipients in by_domain.items():
+            entries = by_relay.setdefault(relay_for(domain), [])
+            for start in range(0, len(domain_recipients), max_recipients):
+                entries.append((spec, (sender, domain_recipients[start:start + max_recipients], message)))
+
+    refused = {}
+    sent = 0
+    unsent = []
+    errors = []
+    for relay, entries in by_relay.items():
+        delivered = []
+        try:
+            refused.update(get_pool(relay).send([envelope for _, envelope in entries], delivered.append))
+        except (smtplib.SMTPException, OSError) as e:
+            errors.append(f"{relay}: {str(e)}")
+            unsent.extend(entries[len(delivered):])
+        sent += len(delivered)
+
+    remaining = {}
+    for spec, (_, recipients, _) in unsent:
+        remaining.setdefault(id(spec), dict(spec, envelope_to=[]))['envelope_to'].extend(recipients)
+    result = {
+        'sent': len(specs) - len(remaining),
+        'envelopes': sent,
+        'recipients': recipient_count,
+        'refused': {recipient: list(error) for recipient, error in refused.items()},
+    }
+    if remaining:
+        raise EmailDeliveryError(
+            f"{len(unsent)} of {sent + len(unsent)} envelopes not delivered: {'; '.join(errors)}",
+            result, list(remaining.values())
+        )
+    return result
+
+
+class _DebuggingSMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        if server.handshake_delay:
+            # Stand-in for the latency of a remote relay's greeting
+            time.sleep(server.handshake_delay)
+        self.reply('220 localhost debugging SMTP server')
+        sender, recipients = None, []
+        for raw in self.rfile:
+            command = raw.decode('utf-8', 'replace').rstrip('\r\n')
+            verb = command[:4].upper()
+            if verb in ('EHLO', 'HELO'):
+                self.reply('250 localhost')
+            elif verb == 'MAIL':
+                sender, recipients = command[10:].strip(), []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                recipients.append(command[8:].strip())
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                lines = []
+                for data in self.rfile:
+                    if data in (b'.\r\n', b'.\n'):
+                        break
+                    lines.append(data[1:] if data.startswith(b'..') else data)
+                with server.lock:
+                    server.messages.append((sender, recipients, b''.join(lines)))
+                if server.verbose:
+                    logger.info(f"Message from {sender} to {recipients} ({sum(map(len, lines))} bytes)")
+                self.reply('250 OK')
+            elif verb == 'RSET':
+                sender, recipients = None, []
+                self.reply('250 OK')
+            elif verb == 'NOOP':
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class DebuggingSMTPServer(socketserver.ThreadingTCPServer):
+    """Minimal SMTP sink that records every message, for tests and benchmarks."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='localhost', port=1025, handshake_delay=0.0, verbose=False):
+        super().__init__((host, port), _DebuggingSMTPHandler)
+        self.handshake_delay = handshake_delay
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.messages = []
+        self.connections = 0
+
+    def start(self):
+        """Serve from a background thread and return the bound port."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.server_address[1]
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    parser = argparse.ArgumentParser(description='Run the debugging SMTP server')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=1025)
+    args = parser.parse_args()
+    server = DebuggingSMTPServer(args.host, args.port, verbose=True)
+    logger.info(f"Debugging SMTP server listening on {args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,432 @@
+"""Embedded broker and result backend on a single SQLite file for one-node setups.
+
+With ``QUEUE_BACKEND=embedded`` the API, workers and Flower share one SQLite
+database in WAL mode (``EMBEDDED_QUEUE_PATH``) instead of RabbitMQ and Redis:
+
+- ``embedded://`` is a kombu virtual transport. Messages are reserved when a
+  worker takes them and deleted when they are acked, so with
+  ``task_acks_late`` a task whose worker dies is delivered again: rejected
+  with requeue when a pool process is lost, put back when the consumer
+  closes its channel, or after ``visibility_timeout`` seconds if the whole
+  worker died. Higher message priorities are delivered first and bindings
+  are stored in the database, so fanout (control commands) works across
+  processes. Like on RabbitMQ, ``auto_delete`` queues (event receivers,
+  control replies) are deleted with their bindings once their consumer is
+  cancelled or their channel closes, queues with ``expires`` are deleted
+  after going unused that long, and messages older than the queue's
+  ``message_ttl`` are dropped.
+- ``embedded_queue:SQLiteBackend`` is a key/value result backend in the same
+  file, with expiry and chord support. Expired results are deleted by the
+  writers themselves, so celery beat is not needed.
+
+Every process polls the database, so this is meant for a single host only.
+"""
+import os
+import sqlite3
+import threading
+import time
+from queue import Empty
+
+from celery.backends.base import KeyValueStoreBackend
+from kombu.transport import TRANSPORT_ALIASES, virtual
+from kombu.transport.base import to_rabbitmq_queue_arguments
+from kombu.utils.json import dumps, loads
+
+import celeryconfig
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    queue TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    delivery_tag TEXT,
+    reserved_at REAL,
+    expires_at REAL,
+    payload TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_ready ON messages (queue, reserved_at, priority DESC, id);
+CREATE INDEX IF NOT EXISTS messages_delivery_tag ON messages (delivery_tag);
+CREATE TABLE IF NOT EXISTS queues (
+    name TEXT PRIMARY KEY,
+    auto_delete INTEGER NOT NULL DEFAULT 0,
+    expires REAL,
+    message_ttl REAL,
+    last_used REAL
+);
+CREATE TABLE IF NOT EXISTS bindings (
+    exchange TEXT NOT NULL,
+    routing_key TEXT NOT NULL,
+    pattern TEXT NOT NULL,
+    queue TEXT NOT NULL,
+    PRIMARY KEY (exchange, routing_key, pattern, queue)
+);
+CREATE TABLE IF NOT EXISTS results (
+    key BLOB PRIMARY KEY,
+    value BLOB,
+    expires REAL
+);
+CREATE INDEX IF NOT EXISTS results_expires ON results (expires);
+"""
+
+# Columns added since the first schema, for databases created before them
+MIGRATIONS = (
+    ('messages', 'expires_at', 'REAL'),
+    ('queues', 'auto_delete', 'INTEGER NOT NULL DEFAULT 0'),
+    ('queues', 'expires', 'REAL'),
+    ('queues', 'message_ttl', 'REAL'),
+    ('queues', 'last_used', 'REAL'),
+)
+INDEXES = """
+CREATE INDEX IF NOT EXISTS messages_expires ON messages (expires_at);
+CREATE INDEX IF NOT EXISTS queues_expires ON queues (expires);
+"""
+
+# Extra attempts when another consumer claims the message we picked
+CLAIM_ATTEMPTS = 5
+
+
+class Database:
+    """One SQLite connection per thread (and per process after fork)."""
+
+    def __init__(self, path, timeout=30.0):
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+
+    @property
+    def conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            # In WAL mode NORMAL only risks the last commits on power loss, not corruption
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA)
+            self._migrate(conn)
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def _migrate(conn):
+        for table, column, definition in MIGRATIONS:
+            columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+            if column not in columns:
+                try:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+                except sqlite3.OperationalError as e:
+                    # Another process added it first
+                    if 'duplicate column' not in str(e):
+                        raise
+        conn.executescript(INDEXES)
+
+    def execute(self, sql, params=()):
+        return self.conn.execute(sql, params)
+
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+def get_database(path):
+    path = os.path.abspath(path)
+    with _databases_lock:
+        if path not in _databases:
+            _databases[path] = Database(path)
+        return _databases[path]
+
+
+class QoS(virtual.QoS):
+    """Acks delete the reserved row, rejects delete or un-reserve it."""
+
+    def ack(self, delivery_tag):
+        self.channel._remove(delivery_tag)
+        super().ack(delivery_tag)
+
+    def reject(self, delivery_tag, requeue=False):
+        if requeue:
+            self.channel._restore_at_beginning(self._delivered[delivery_tag])
+        else:
+            self.channel._remove(delivery_tag)
+        self._quick_ack(delivery_tag)
+
+
+class Channel(virtual.Channel):
+    QoS = QoS
+    supports_fanout = True
+    visibility_timeout = 3600
+    from_transport_options = virtual.Channel.from_transport_options + ('visibility_timeout', 'path')
+    path = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.db = get_database(self.path or celeryconfig.embedded_queue_path)
+        self._noack_queues = set()
+        self._last_requeue = 0.0
+        # Queues this channel declared with auto_delete or expires
+        self._auto_delete_queues = set()
+        self._queue_expires = {}
+        self._last_touch = 0.0
+
+    def prepare_queue_arguments(self, arguments, **kwargs):
+        # Turn Queue(expires=..., message_ttl=...) into x-expires/x-message-ttl like AMQP does
+        return to_rabbitmq_queue_arguments(arguments, **kwargs)
+
+    def basic_consume(self, queue, no_ack, *args, **kwargs):
+        if no_ack:
+            self._noack_queues.add(queue)
+        return super().basic_consume(queue, no_ack, *args, **kwargs)
+
+    def basic_cancel(self, consumer_tag):
+        queue = self._tag_to_queue.get(consumer_tag)
+        self._noack_queues.discard(queue)
+        result = super().basic_cancel(consumer_tag)
+        if queue in self._auto_delete_queues and queue not in self._active_queues:
+            # Its last consumer is gone
+            self._delete_queue(queue)
+        return result
+
+    def close(self):
+        if not self.closed:
+            super().close()
+            # auto_delete queues that were declared but never consumed go too
+            for queue in list(self._auto_delete_queues):
+                self._delete_queue(queue)
+
+    def basic_get(self, queue, no_ack=False, **kwargs):
+        message = super().basic_get(queue, no_ack, **kwargs)
+        if message is not None and no_ack:
+            self._remove(message.delivery_tag)
+        return message
+
+    def _requeue_expired(self):
+        """Put back messages reserved longer than visibility_timeout, e.g. by a dead worker.
+
+        Also drops messages past their queue's message TTL and queues unused
+        for longer than their expires, with their bindings and messages.
+        """
+        now = time.time()
+        if now - self._last_requeue < min(self.visibility_timeout / 10.0, 60.0):
+            return
+        self._last_requeue = now
+        self.db.execute(
+            'UPDATE messages SET reserved_at = NULL WHERE reserved_at < ?',
+            (now - self.visibility_timeout,)
+        )
+        self.db.execute('DELETE FROM messages WHERE expires_at <= ? AND reserved_at IS NULL', (now,))
+        expired = self.db.execute(
+            'SELECT name FROM queues WHERE expires IS NOT NULL AND last_used + expires < ?', (now,)
+        ).fetchall()
+        for (queue,) in expired:
+            self._delete_queue(queue)
+
+    def _touch_queues(self):
+        """Mark the expiring queues this channel consumes from as in use."""
+        active = [queue for queue in self._active_queues if queue in self._queue_expires]
+        if not active:
+            return
+        now = time.time()
+        # Often enough that no consumed queue can reach its expiry between two touches
+        if now - self._last_touch < min(self._queue_expires[queue] for queue in active) / 3.0:
+            return
+        self._last_touch = now
+        self.db.execute(
+            f"UPDATE queues SET last_used = ? WHERE name IN ({', '.join('?' * len(active))})",
+            (now, *active)
+        )
+
+    def _get(self, queue, timeout=None):
+        self._requeue_expired()
+        self._touch_queues()
+        for _ in range(CLAIM_ATTEMPTS):
+            # Look without taking the write lock, so idle polls never block publishers
+            row = self.db.execute(
+                'SELECT id, payload FROM messages WHERE queue = ? AND reserved_at IS NULL '
+                'AND (expires_at IS NULL OR expires_at > ?) ORDER BY priority DESC, id LIMIT 1',
+                (queue, time.time())
+            ).fetchone()
+            if row is None:
+                raise Empty()
+            if queue in self._noack_queues:
+                claimed = self.db.execute('DELETE FROM messages WHERE id = ?', (row[0],)).rowcount
+            else:
+                claimed = self.db.execute(
+                    'UPDATE messages SET reserved_at = ? WHERE id = ? AND reserved_at IS NULL',
+                    (time.time(), row[0])
+                ).rowcount
+            if claimed:
+                return loads(row[1])
+        raise Empty()
+
+    def _put(self, queue, message, **kwargs):
+        # Fanout and multi-queue routes store one copy per queue, each needs its own tag to be acked
+        properties = dict(message['properties'], delivery_tag=self._next_delivery_tag())
+        message = dict(message, properties=properties)
+        # Messages of a queue with a message TTL expire that long after they are published
+        self.db.execute(
+            'INSERT INTO messages (queue, priority, delivery_tag, payload, expires_at) '
+            'VALUES (?, ?, ?, ?, ? + (SELECT message_ttl FROM queues WHERE name = ?))',
+            (queue, self._get_message_priority(message), message['properties']['delivery_tag'],
+             dumps(message), time.time(), queue)
+        )
+
+    def _put_fanout(self, exchange, message, routing_key, **kwargs):
+        for queue in self._fanout_queues(exchange):
+            self._put(queue, message, **kwargs)
+
+    def _fanout_queues(self, exchange):
+        return [row[0] for row in self.db.execute(
+            'SELECT DISTINCT queue FROM bindings WHERE exchange = ?', (exchange,)
+        )]
+
+    def _remove(self, delivery_tag):
+        self.db.execute('DELETE FROM messages WHERE delivery_tag = ?', (delivery_tag,))
+
+    def _restore(self, message):
+        # The row is still there, just make it visible again in its original position
+        self.db.execute(
+            'UPDATE messages SET reserved_at = NULL WHERE delivery_tag = ?',
+            (message.delivery_tag,)
+        )
+
+    def _size(self, queue):
+        return self.db.execute(
+            'SELECT COUNT(*) FROM messages WHERE queue = ? AND reserved_at IS NULL '
+            'AND (expires_at IS NULL OR expires_at > ?)',
+            (queue, time.time())
+        ).fetchone()[0]
+
+    def _purge(self, queue):
+        return self.db.execute(
+            'DELETE FROM messages WHERE queue = ? AND reserved_at IS NULL', (queue,)
+        ).rowcount
+
+    def _new_queue(self, queue, auto_delete=False, arguments=None, **kwargs):
+        arguments = arguments or {}
+        expires = arguments.get('x-expires')
+        message_ttl = arguments.get('x-message-ttl')
+        expires = expires / 1000.0 if expires is not None else None
+        message_ttl = message_ttl / 1000.0 if message_ttl is not None else None
+        self.db.execute(
+            'INSERT INTO queues (name, auto_delete, expires, message_ttl, last_used) VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT (name) DO UPDATE SET auto_delete = excluded.auto_delete, expires = excluded.expires, '
+            'message_ttl = excluded.message_ttl, last_used = excluded.last_used',
+            (queue, int(bool(auto_delete)), expires, message_ttl, time.time())
+        )
+        if auto_delete:
+            self._auto_delete_queues.add(queue)
+        if expires is not None:
+            self._queue_expires[queue] = expires
+
+    def _has_queue(self, queue, **kwargs):
+        return self.db.execute('SELECT 1 FROM queues WHERE name = ?', (queue,)).fetchone() is not None
+
+    def _delete(self, queue, *args, **kwargs):
+        self.db.execute('DELETE FROM messages WHERE queue = ?', (queue,))
+        self.db.execute('DELETE FROM bindings WHERE queue = ?', (queue,))
+        self.db.execute('DELETE FROM queues WHERE name = ?', (queue,))
+
+    def _delete_queue(self, queue):
+        self._delete(queue)
+        self.state.queue_bindings_delete(queue)
+        self._auto_delete_queues.discard(queue)
+        self._queue_expires.pop(queue, None)
+
+    def _queue_bind(self, exchange, routing_key, pattern, queue):
+        self.db.execute(
+            'INSERT OR IGNORE INTO bindings (exchange, routing_key, pattern, queue) VALUES (?, ?, ?, ?)',
+            (exchange, routing_key or '', pattern or '', queue)
+        )
+
+    def get_table(self, exchange):
+        # Bindings declared by other processes count too
+        return [tuple(row) for row in self.db.execute(
+            'SELECT routing_key, pattern, queue FROM bindings WHERE exchange = ?', (exchange,)
+        )]
+
+
+class Transport(virtual.Transport):
+    Channel = Channel
+
+    # Idle consumers poll the database, keep it short for low latency
+    polling_interval = 0.05
+    default_port = None
+    driver_type = 'sqlite'
+    driver_name = 'sqlite3'
+
+    implements = virtual.Transport.implements.extend(
+        exchange_type=frozenset(['direct', 'topic', 'fanout']),
+    )
+
+    def driver_version(self):
+        return sqlite3.sqlite_version
+
+
+TRANSPORT_ALIASES.setdefault('embedded', 'embedded_queue:Transport')
+
+
+class SQLiteBackend(KeyValueStoreBackend):
+    """Result backend storing results in the embedded queue database."""
+
+    # Beat's backend_cleanup is skipped for autoexpiring backends, set() deletes expired rows instead
+    supports_autoexpire = True
+    implements_incr = True
+    cleanup_interval = 60.0
+
+    def __init__(self, url=None, path=None, **kwargs):
+        super().__init__(url=url, **kwargs)
+        self.path = path or self.app.conf.get('embedded_queue_path') or celeryconfig.embedded_queue_path
+        self.db = get_database(self.path)
+        self._last_cleanup = 0.0
+
+    def _expires_at(self):
+        return time.time() + self.expires if self.expires else None
+
+    def get(self, key):
+        row = self.db.execute(
+            'SELECT value FROM results WHERE key = ? AND (expires IS NULL OR expires > ?)',
+            (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def mget(self, keys):
+        keys = list(keys)
+        if not keys:
+            return []
+        rows = dict(self.db.execute(
+            f"SELECT key, value FROM results WHERE key IN ({', '.join('?' * len(keys))}) "
+            'AND (expires IS NULL OR expires > ?)',
+            (*keys, time.time())
+        ).fetchall())
+        return [rows.get(key) for key in keys]
+
+    def set(self, key, value):
+        self.db.execute(
+            'INSERT OR REPLACE INTO results (key, value, expires) VALUES (?, ?, ?)',
+            (key, value, self._expires_at())
+        )
+        now = time.time()
+        if now - self._last_cleanup >= self.cleanup_interval:
+            self._last_cleanup = now
+            self.cleanup()
+
+    def delete(self, key):
+        self.db.execute('DELETE FROM results WHERE key = ?', (key,))
+
+    def incr(self, key):
+        return self.db.execute(
+            'INSERT INTO results (key, value, expires) VALUES (?, 1, ?) '
+            'ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1 RETURNING value',
+            (key, self._expires_at())
+        ).fetchone()[0]
+
+    def expire(self, key, value):
+        self.db.execute('UPDATE results SET expires = ? WHERE key = ?', (time.time() + value, key))
+
+    def cleanup(self):
+        self.db.execute('DELETE FROM results WHERE expires <= ?', (time.time(),))
+
+    def __reduce__(self, args=(), kwargs=None):
+        kwargs = {} if not kwargs else kwargs
+        return super().__reduce__(args, dict(kwargs, path=self.path))
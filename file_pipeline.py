@@ -0,0 +1,252 @@
+"""Streaming, chunked file processing for file_processing tasks.
+
+Input is read in fixed-size chunks (optionally through mmap), split into
+lines and pushed through a pipeline of generator stages, so memory use stays
+flat regardless of file size. Large files can be split into byte ranges that
+are processed independently and merged afterwards; a line belongs to the
+range in which it starts, so ranges never need to be aligned by the caller.
+
+Stages are given as names or dicts, e.g.
+    ['lower', {'op': 'grep', 'pattern': 'error'}, {'op': 'replace', 'pattern': 'a', 'replacement': 'b'}]
+"""
+import mmap
+import os
+import re
+import shutil
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+DEFAULT_MAX_LINE_BYTES = 64 * 1024 * 1024
+MMAP_WINDOW_CHUNKS = 16
+
+
+class PipelineError(Exception):
+    pass
+
+
+def iter_chunks(path, start=0, end=None, chunk_size=DEFAULT_CHUNK_SIZE, use_mmap=False, on_chunk=None):
+    """Yield the bytes of path[start:end] in chunks of at most chunk_size."""
+    if chunk_size <= 0:
+        raise PipelineError(f"chunk_size must be positive, got {chunk_size}")
+    with open(path, 'rb') as fh:
+        size = os.fstat(fh.fileno()).st_size
+        end = size if end is None else min(end, size)
+        if start >= end:
+            return
+        if use_mmap:
+            # Map a bounded window at a time so resident pages do not grow with the file
+            window = chunk_size * MMAP_WINDOW_CHUNKS
+            for window_start in range(start, end, window):
+                aligned = window_start - window_start % mmap.ALLOCATIONGRANULARITY
+                window_end = min(window_start + window, end)
+                with mmap.mmap(fh.fileno(), window_end - aligned, offset=aligned,
+                               access=mmap.ACCESS_READ) as mm:
+                    for offset in range(window_start, window_end, chunk_size):
+                        chunk = mm[offset - aligned:min(offset + chunk_size, window_end) - aligned]
+                        if on_chunk:
+                            on_chunk(offset + len(chunk))
+                        yield chunk
+            return
+        fh.seek(start)
+        position = start
+        while position < end:
+            chunk = fh.read(min(chunk_size, end - position))
+            if not chunk:
+                break
+            position += len(chunk)
+            if on_chunk:
+                on_chunk(position)
+            yield chunk
+
+
+def iter_lines(chunks, max_line_bytes=DEFAULT_MAX_LINE_BYTES):
+    """Split a stream of chunks into lines, keeping the trailing newline.
+
+    The pieces of a line that spans chunks are joined once, when its newline
+    arrives, and a line longer than max_line_bytes raises PipelineError.
+    """
+    pieces, pending = [], 0
+    for chunk in chunks:
+        lines = chunk.split(b'\n')
+        if pieces:
+            pieces.append(lines[0])
+            pending += len(lines[0])
+            if len(lines) > 1:
+                lines[0] = b''.join(pieces)
+                pieces, pending = [], 0
+        tail = lines.pop()
+        if not pieces:
+            pieces, pending = [tail], len(tail)
+        if max_line_bytes and pending > max_line_bytes:
+            raise PipelineError(f"Line longer than {max_line_bytes} bytes")
+        for line in lines:
+            yield line + b'\n'
+    tail = b''.join(pieces)
+    if tail:
+        yield tail
+
+
+def iter_range_lines(path, start=0, end=None, chunk_size=DEFAULT_CHUNK_SIZE, use_mmap=False, on_chunk=None,
+                     max_line_bytes=DEFAULT_MAX_LINE_BYTES):
+    """Yield the lines that start inside the byte range [start, end)."""
+    skip_partial = False
+    if start > 0:
+        with open(path, 'rb') as fh:
+            fh.seek(start - 1)
+            skip_partial = fh.read(1) != b'\n'
+
+    position = start
+    # Read past end so the last line that starts in range is complete
+    for line in iter_lines(iter_chunks(path, start, None, chunk_size, use_mmap, on_chunk), max_line_bytes):
+        if skip_partial:
+            # This line started in the previous range
+            skip_partial = False
+            position += len(line)
+            continue
+        if end is not None and position >= end:
+            break
+        position += len(line)
+        yield line
+
+
+def resolve_path(path, root):
+    """Resolve path (relative paths against root) and require it to stay under root."""
+    root = os.path.realpath(root)
+    resolved = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, resolved]) != root:
+        raise PipelineError(f"Path {path} is outside the data root {root}")
+    return resolved
+
+
+def part_path(output, index):
+    """Output file of the index-th byte range of a split run."""
+    return f"{output}.part{index}"
+
+
+def split_ranges(size, parts):
+    """Split [0, size) into at most `parts` contiguous byte ranges."""
+    parts = max(1, min(parts, size or 1))
+    step = -(-size // parts)
+    return [(offset, min(offset + step, size)) for offset in range(0, size, step)] or [(0, 0)]
+
+
+def _grep(lines, pattern, **kw):
+    regex = re.compile(pattern.encode())
+    return (line for line in lines if regex.search(line))
+
+
+def _exclude(lines, pattern, **kw):
+    regex = re.compile(pattern.encode())
+    return (line for line in lines if not regex.search(line))
+
+
+def _replace(lines, pattern, replacement='', **kw):
+    regex = re.compile(pattern.encode())
+    replacement = replacement.encode()
+    return (regex.sub(replacement, line) for line in lines)
+
+
+def _strip(lines, **kw):
+    return (line.strip() + b'\n' for line in lines)
+
+
+STAGES = {
+    'grep': _grep,
+    'exclude': _exclude,
+    'replace': _replace,
+    'upper': lambda lines, **kw: (line.upper() for line in lines),
+    'lower': lambda lines, **kw: (line.lower() for line in lines),
+    'strip': _strip,
+}
+
+
+def build_pipeline(lines, stages):
+    """Chain the configured stages onto a line iterator."""
+    for stage in stages or []:
+        spec = {'op': stage} if isinstance(stage, str) else dict(stage)
+        op = spec.pop('op', None)
+        if op not in STAGES:
+            raise PipelineError(f"Unknown pipeline stage: {op}")
+        try:
+            lines = STAGES[op](lines, **spec)
+        except (TypeError, re.error) as e:
+            raise PipelineError(f"Invalid arguments for stage {op}: {str(e)}")
+    return lines
+
+
+class _Counter:
+    def __init__(self, lines):
+        self.lines = lines
+        self.count = 0
+        self.bytes = 0
+
+    def __iter__(self):
+        for line in self.lines:
+            self.count += 1
+            self.bytes += len(line)
+            yield line
+
+
+def process_file(path, stages=None, start=0, end=None, output=None,
+                 chunk_size=DEFAULT_CHUNK_SIZE, use_mmap=False, on_progress=None,
+                 max_line_bytes=DEFAULT_MAX_LINE_BYTES):
+    """Run the pipeline over path[start:end] and return line/byte counts.
+
+    Transformed lines are written to `output` when given, otherwise only
+    counted. `on_progress` receives the percentage of the range read so far.
+    """
+    size = os.path.getsize(path)
+    end = size if end is None else min(end, size)
+    span = max(end - start, 1)
+
+    def on_chunk(position):
+        if on_progress:
+            on_progress(min((position - start) * 100.0 / span, 100.0))
+
+    source = _Counter(iter_range_lines(path, start, end, chunk_size, use_mmap, on_chunk, max_line_bytes))
+    sink = _Counter(build_pipeline(iter(source), stages))
+
+    if output:
+        with open(output, 'wb', buffering=chunk_size) as out:
+            for line in sink:
+                out.write(line)
+    else:
+        for _ in sink:
+            pass
+
+    return {
+        'start': start,
+        'end': end,
+        'input_lines': source.count,
+        'input_bytes': source.bytes,
+        'output_lines': sink.count,
+        'output_bytes': sink.bytes,
+        'output': output,
+    }
+
+
+def merge_results(results, output=None):
+    """Combine per-range results in range order, concatenating part outputs.
+
+    Only the part files this split run wrote next to `output` are read and
+    removed; a result naming any other file is rejected.
+    """
+    results = sorted(results, key=lambda result: result['start'])
+    if output:
+        for index, result in enumerate(results):
+            if result.get('output') != part_path(output, index):
+                raise PipelineError(f"Unexpected output {result.get('output')} for part {index} of {output}")
+    merged = {
+        'parts': len(results),
+        'input_lines': sum(result['input_lines'] for result in results),
+        'input_bytes': sum(result['input_bytes'] for result in results),
+        'output_lines': sum(result['output_lines'] for result in results),
+        'output_bytes': sum(result['output_bytes'] for result in results),
+        'output': output,
+    }
+    if output:
+        with open(output, 'wb') as out:
+            for result in results:
+                with open(result['output'], 'rb') as part:
+                    shutil.copyfileobj(part, out, DEFAULT_CHUNK_SIZE)
+                os.remove(result['output'])
+    return merged
@@ -0,0 +1,141 @@
+"""Progress reporting for task handlers with coalesced result backend writes.
+
+Handlers call ``report_progress(pct, meta)`` as often as they like. Only the
+latest value is kept, and it is written to the result backend as a PROGRESS
+state at most ``task_progress_max_updates_per_second`` times per task, so
+fine-grained progress does not turn into a write storm. A throttled update is
+written by a timer once the interval has passed, so the last value reported
+is never lost. Tasks use ``ProgressTask`` as their base class, which stops
+the timer before the final state is stored.
+"""
+import threading
+import time
+
+from celery import Task, current_task
+from celery.signals import task_postrun
+
+import celeryconfig
+
+PROGRESS_STATE = 'PROGRESS'
+
+_reporters = {}
+_reporters_lock = threading.Lock()
+
+
+class ProgressReporter:
+    """Coalesces progress updates for a single task execution."""
+
+    def __init__(self, task, task_id, max_updates_per_second):
+        self.task = task
+        self.task_id = task_id
+        self.min_interval = 1.0 / max_updates_per_second if max_updates_per_second else 0.0
+        self.lock = threading.Lock()
+        self.last_write = None
+        self.pending = None
+        self.timer = None
+        self.closed = False
+        self.writes = 0
+
+    def report(self, pct, meta=None, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            if self.closed:
+                return
+            self.pending = {
+                'status': 'Task in progress',
+                'progress': min(max(float(pct), 0.0), 100.0),
+                'meta': meta or {},
+            }
+            if self.last_write is None or now - self.last_write >= self.min_interval:
+                self._write(now)
+            elif self.timer is None:
+                # Trailing write, so the latest value lands even if no report follows
+                self.timer = threading.Timer(self.last_write + self.min_interval - now, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self, now=None):
+        """Write the latest pending update, if any, regardless of the throttle."""
+        with self.lock:
+            if not self.closed:
+                self._write(now)
+
+    def close(self):
+        """Drop any pending update; the task's final state replaces it."""
+        with self.lock:
+            self.closed = True
+            self.pending = None
+            self._cancel_timer()
+
+    def _cancel_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def _write(self, now=None):
+        self._cancel_timer()
+        if self.pending is None:
+            return
+        # Pass the id explicitly, the timer thread has no request context
+        self.task.update_state(task_id=self.task_id, state=PROGRESS_STATE, meta=self.pending)
+        self.pending = None
+        self.last_write = time.monotonic() if now is None else now
+        self.writes += 1
+
+
+def _get_reporter():
+    task = current_task
+    if not task or not task.request.id or task.request.called_directly:
+        return None
+    with _reporters_lock:
+        reporter = _reporters.get(task.request.id)
+        if reporter is None:
+            reporter = ProgressReporter(
+                task._get_current_object(), task.request.id,
+                celeryconfig.task_progress_max_updates_per_second
+            )
+            _reporters[task.request.id] = reporter
+        return reporter
+
+
+def report_progress(pct, meta=None):
+    """Report progress (0-100) of the current task with optional extra meta.
+
+    Outside of a worker, e.g. when a handler is called directly, this is a no-op.
+    """
+    reporter = _get_reporter()
+    if reporter is not None:
+        reporter.report(pct, meta)
+
+
+def flush_progress():
+    """Force out the latest throttled update of the current task."""
+    reporter = _get_reporter()
+    if reporter is not None:
+        reporter.flush()
+
+
+def close_progress(task_id):
+    with _reporters_lock:
+        reporter = _reporters.pop(task_id, None)
+    if reporter is not None:
+        reporter.close()
+
+
+class ProgressTask(Task):
+    """Task base class that stops progress writes before the final state is stored."""
+
+    def __call__(self, *args, **kwargs):
+        if self.request.called_directly:
+            return super().__call__(*args, **kwargs)
+        # The worker has already pushed the request; Task.__call__ would push an empty one
+        try:
+            return self.run(*args, **kwargs)
+        finally:
+            close_progress(self.request.id)
+
+
+@task_postrun.connect
+def discard_reporter(task_id=None, **kw):
+    # Fallback for tasks that do not use ProgressTask
+    close_progress(task_id)
@@ -0,0 +1,74 @@
+"""Broker-side queue metrics shared by the autoscaler and admission control."""
+import logging
+import threading
+import time
+
+import sharding
+
+logger = logging.getLogger(__name__)
+
+
+def get_queue_depths(app, queue_names):
+    """Return {queue: {'messages': n, 'consumers': n}} using passive declares.
+
+    Queues that do not exist yet are reported as empty. With sharded brokers
+    each queue is sampled on the shard that owns it.
+    """
+    by_broker = {}
+    for name in queue_names:
+        by_broker.setdefault(sharding.broker_url_for(name), []).append(name)
+
+    depths = {}
+    for url, names in by_broker.items():
+        with app.connection_for_read(url) as conn:
+            channel = conn.channel()
+            try:
+                for name in names:
+                    try:
+                        _, messages, consumers = channel.queue_declare(queue=name, passive=True)
+                    except conn.channel_errors:
+                        # A failed passive declare closes the channel on AMQP
+                        depths[name] = {'messages': 0, 'consumers': 0}
+                        channel = conn.channel()
+                        continue
+                    depths[name] = {'messages': messages, 'consumers': consumers}
+            finally:
+                channel.close()
+    return depths
+
+
+class RateTracker:
+    """Exponentially weighted per-key rate estimate from monotonic counters."""
+
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self.lock = threading.Lock()
+        self.last = {}
+        self.rates = {}
+
+    def update(self, key, count, now=None):
+        """Record a counter value for key and return the smoothed rate per second."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            previous = self.last.get(key)
+            self.last[key] = (count, now)
+            if previous is None:
+                return self.rates.get(key)
+            elapsed = now - previous[1]
+            if elapsed <= 0:
+                return self.rates.get(key)
+            rate = max(count - previous[0], 0) / elapsed
+            if key in self.rates:
+                rate = self.alpha * rate + (1 - self.alpha) * self.rates[key]
+            self.rates[key] = rate
+            return rate
+
+    def mark(self, key, count, now=None):
+        """Move the baseline for key to count without changing its rate."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            self.last[key] = (count, now)
+
+    def rate(self, key):
+        with self.lock:
+            return self.rates.get(key)
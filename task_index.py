@@ -0,0 +1,137 @@
+"""Secondary index of tasks by state, type and priority for search queries.
+
+Every process_task state change is recorded in Redis sorted sets scored by
+the time of the change, one set per combination of the state, type and
+priority filters (eight per task). A query reads exactly one set with
+ZREVRANGEBYSCORE, so it costs O(log N + page size) no matter how many tasks
+are stored and never scans the keyspace. Each indexed task also has a small
+hash with its current fields, and entries older than
+``task_index_retention_seconds`` are trimmed from a set whenever it is
+written or searched, so sets that stop receiving writes do not keep stale
+ids.
+"""
+import itertools
+import time
+from datetime import datetime, timezone
+
+from celery.backends.redis import RedisBackend
+
+import celeryconfig
+
+STATES = ('PENDING', 'STARTED', 'RETRY', 'SUCCESS', 'FAILURE')
+
+_index = None
+
+
+class TaskIndex:
+    def __init__(self, client, retention_seconds=7 * 24 * 3600, prefix='task_index'):
+        self.client = client
+        self.retention_seconds = retention_seconds
+        self.prefix = prefix
+
+    def _key(self, state=None, task_type=None, priority=None):
+        filters = [
+            f"{name}={value}"
+            for name, value in (('state', state), ('type', task_type), ('priority', priority))
+            if value is not None
+        ]
+        return f"{self.prefix}:{'|'.join(filters) or 'all'}"
+
+    def _keys(self, state, task_type, priority):
+        """Every set a task with these fields belongs to."""
+        return [
+            self._key(*combination)
+            for combination in itertools.product((state, None), (task_type, None), (priority, None))
+        ]
+
+    def _task_key(self, task_id):
+        return f"{self.prefix}:task:{task_id}"
+
+    def record(self, task_id, task_type, priority, state, timestamp=None):
+        """Move a task to `state`, scored by the time of the change."""
+        timestamp = time.time() if timestamp is None else timestamp
+        task_key = self._task_key(task_id)
+        previous = _decode(self.client.hget(task_key, 'state'))
+        pipe = self.client.pipeline()
+        if previous and previous != state:
+            # Only the first four keys filter on state, the others stay valid
+            for key in self._keys(previous, task_type, priority)[:4]:
+                pipe.zrem(key, task_id)
+        for key in self._keys(state, task_type, priority):
+            pipe.zadd(key, {task_id: timestamp})
+            pipe.zremrangebyscore(key, '-inf', timestamp - self.retention_seconds)
+        pipe.hset(task_key, mapping={
+            'task_type': task_type,
+            'priority': priority,
+            'state': state,
+            'updated_at': timestamp,
+        })
+        pipe.expire(task_key, int(self.retention_seconds))
+        pipe.execute()
+
+    def remove(self, task_id, task_type, priority):
+        """Drop a task from every set and delete its hash."""
+        pipe = self.client.pipeline()
+        for state in STATES:
+            for key in self._keys(state, task_type, priority):
+                pipe.zrem(key, task_id)
+        pipe.delete(self._task_key(task_id))
+        pipe.execute()
+
+    def search(self, state=None, task_type=None, priority=None, since=None, until=None, limit=50, offset=0):
+        """Return the newest matching tasks first, with the total match count."""
+        key = self._key(state, task_type, priority)
+        low = '-inf' if since is None else since
+        high = '+inf' if until is None else until
+
+        pipe = self.client.pipeline()
+        pipe.zremrangebyscore(key, '-inf', time.time() - self.retention_seconds)
+        pipe.zrevrangebyscore(key, high, low, start=offset, num=limit, withscores=True)
+        pipe.zcount(key, low, high)
+        _, entries, total = pipe.execute()
+
+        pipe = self.client.pipeline()
+        for task_id, _ in entries:
+            pipe.hgetall(self._task_key(_decode(task_id)))
+        details = pipe.execute() if entries else []
+
+        tasks = []
+        for (task_id, score), fields in zip(entries, details):
+            fields = {_decode(name): _decode(value) for name, value in fields.items()}
+            tasks.append({
+                'task_id': _decode(task_id),
+                'task_type': fields.get('task_type', task_type),
+                'priority': fields.get('priority', priority),
+                'state': fields.get('state', state),
+                'updated_at': datetime.fromtimestamp(score, timezone.utc).isoformat(),
+            })
+        return {'total': total, 'limit': limit, 'offset': offset, 'tasks': tasks}
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def parse_time(value):
+    """Parse a unix timestamp or an ISO 8601 date/time into a unix timestamp."""
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise ValueError(f"Invalid time: {value}, expected a unix timestamp or ISO 8601")
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def get_index(app):
+    """Index on the app's Redis result backend, or None if it is disabled or unsupported."""
+    global _index
+    if _index is None and celeryconfig.task_index_enabled and isinstance(app.backend, RedisBackend):
+        _index = TaskIndex(app.backend.client, celeryconfig.task_index_retention_seconds)
+    return _index
@@ -1,5 +1,7 @@
-from celery import Celery
-from celery.signals import task_failure, task_success
+from celery import Celery, chord
+from celery.exceptions import Retry
+from celery.utils import uuid
+from celery.signals import task_failure, task_prerun, task_retry, task_success
 import os
 from dotenv import load_dotenv
 import time
@@ -8,6 +10,14 @@ import traceback
 import json
 from celery.utils.log import get_task_logger
 import random
+from progress import PROGRESS_STATE, report_progress
+import file_pipeline
+import data_engine
+import email_delivery
+import task_index
+import sharding
+import embedded_queue  # Registers the embedded:// transport
+import worker_resources  # Registers the resource cache lifecycle hooks and inspect command
 
 load_dotenv()
 
@@ -17,11 +27,15 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-celery_app = Celery('tasks')
+celery_app = Celery('tasks', task_cls='progress:ProgressTask')
 celery_app.config_from_object('celeryconfig')
 
 task_logger = get_task_logger(__name__)
 
+# Knobs for the simulated handlers, used by benchmark.py to get reproducible runs
+SIMULATED_WORK_SCALE = float(os.getenv('SIMULATED_WORK_SCALE', '1.0'))
+SIMULATED_FAILURE_RATE = float(os.getenv('SIMULATED_FAILURE_RATE', '0.1'))
+
 class TaskError(Exception):
     def __init__(self, message, details=None):
         super().__init__(message)
@@ -33,20 +47,149 @@ class TaskError(Exception):
             'details': self.details
         }
 
+class InvalidTaskError(TaskError):
+    """Bad task input; it fails the same way every time, so it is never retried."""
+
+def simulate_work(seconds, steps=10):
+    """Sleep for the scaled duration, reporting progress along the way."""
+    for step in range(steps):
+        time.sleep(seconds * SIMULATED_WORK_SCALE / steps)
+        report_progress((step + 1) * 100.0 / steps)
+
 def process_data_task(parameters):
     task_logger.debug(f"Processing data task with parameters: {parameters}")
-    time.sleep(2)  # Simulate work
-    return {'processed': True, 'data': parameters}
+    if 'columns' not in parameters and 'path' not in parameters:
+        # No columnar input, keep the simulated behaviour
+        simulate_work(2)
+        return {'processed': True, 'data': parameters}
+
+    # Input files are confined to the data root, like file task paths
+    path = resolve_data_path(parameters.get('path'))
+    if path and not os.path.isfile(path):
+        raise InvalidTaskError(f"File not found: {parameters.get('path')}", {'path': path})
+
+    def on_batch(engine, total_rows):
+        meta = {'rows_processed': engine.rows_in, 'rows_matched': engine.rows_matched}
+        partial = engine.partial(celery_app.conf.data_partial_max_groups)
+        if partial is not None:
+            meta['partial'] = partial
+        report_progress(engine.rows_in * 100.0 / total_rows if total_rows else 0.0, meta)
+
+    result = data_engine.run(
+        parameters.get('operations', []),
+        columns=parameters.get('columns'),
+        path=path,
+        batch_size=int(parameters.get('batch_size', celery_app.conf.data_batch_size)),
+        max_output_rows=celery_app.conf.data_max_output_rows,
+        on_batch=on_batch
+    )
+    return {'processed': True, **result}
 
 def send_email_task(parameters):
     task_logger.debug(f"Processing email task with parameters: {parameters}")
-    time.sleep(1)  # Simulate work
-    return {'sent': True, 'to': parameters.get('to')}
+    if not celery_app.conf.email_delivery_enabled:
+        time.sleep(1 * SIMULATED_WORK_SCALE)  # Simulate work
+        return {'sent': True, 'to': parameters.get('to')}
+
+    # A task carries either one message or a batch under 'messages'
+    messages = parameters.get('messages') or [parameters]
+    # Counts from earlier attempts of a partially delivered batch
+    previous = parameters.get('previous') or {'envelopes': 0, 'refused': {}}
+    try:
+        result = email_delivery.deliver(messages)
+    except email_delivery.EmailDeliveryError as e:
+        if not e.remaining:
+            raise TaskError(str(e))
+        delivered = {
+            'envelopes': previous['envelopes'] + e.result['envelopes'],
+            'refused': {**previous['refused'], **e.result['refused']},
+        }
+        # Retry only the envelopes that did not go out, never resend the others
+        raise TaskError(str(e), {**delivered, 'retry_parameters': {'messages': e.remaining, 'previous': delivered}})
+    result['envelopes'] += previous['envelopes']
+    result['refused'] = {**previous['refused'], **result['refused']}
+    return {'sent': True, 'to': parameters.get('to'), **result}
+
+def resolve_data_path(path):
+    """Resolve a file task path under file_data_root, rejecting anything outside it."""
+    if not path:
+        return None
+    try:
+        return file_pipeline.resolve_path(path, celery_app.conf.file_data_root)
+    except file_pipeline.PipelineError as e:
+        raise InvalidTaskError(str(e), {'path': path})
+
+def file_chunk_size(value):
+    """Validate a requested chunk_size, defaulting to file_chunk_size."""
+    if value is None:
+        return celery_app.conf.file_chunk_size
+    try:
+        chunk_size = int(value)
+    except (TypeError, ValueError):
+        raise InvalidTaskError(f"Invalid chunk_size: {value!r}", {'chunk_size': value})
+    if not 0 < chunk_size <= celery_app.conf.file_max_chunk_size:
+        raise InvalidTaskError(
+            f"chunk_size must be between 1 and {celery_app.conf.file_max_chunk_size}",
+            {'chunk_size': value}
+        )
+    return chunk_size
+
+def file_parts(value, size):
+    """Number of subtasks for a file of size bytes, clamped to sane bounds."""
+    try:
+        parts = int(value or 0)
+    except (TypeError, ValueError):
+        raise InvalidTaskError(f"Invalid parts: {value!r}", {'parts': value})
+    if not parts and size > celery_app.conf.file_split_threshold:
+        parts = -(-size // celery_app.conf.file_split_part_size)
+    # Never more parts than min-size pieces of the file, nor than the configured cap
+    max_parts = min(-(-size // celery_app.conf.file_min_part_size), celery_app.conf.file_max_parts)
+    return max(min(parts, max_parts), 0)
 
 def process_file_task(parameters):
     task_logger.debug(f"Processing file task with parameters: {parameters}")
-    time.sleep(3)  # Simulate work
-    return {'processed': True, 'filename': parameters.get('filename')}
+    filename = resolve_data_path(parameters.get('filename'))
+    if not filename or not os.path.isfile(filename):
+        if filename and (parameters.get('stages') or parameters.get('output')):
+            # Real work was asked for, a missing file must not look like success
+            raise InvalidTaskError(f"File not found: {parameters.get('filename')}", {'filename': filename})
+        # No real input file, keep the simulated behaviour
+        simulate_work(3)
+        return {'processed': True, 'filename': parameters.get('filename')}
+
+    output = resolve_data_path(parameters.get('output'))
+    options = {
+        'stages': parameters.get('stages'),
+        'chunk_size': file_chunk_size(parameters.get('chunk_size')),
+        'use_mmap': bool(parameters.get('mmap', False)),
+        'max_line_bytes': celery_app.conf.file_max_line_bytes,
+    }
+    size = os.path.getsize(filename)
+    parts = file_parts(parameters.get('parts'), size)
+
+    if parts > 1:
+        # Fan the byte ranges out across file workers and merge at the end
+        ranges = file_pipeline.split_ranges(size, parts)
+        header = [
+            process_file_range.s(
+                filename, start, end,
+                output=file_pipeline.part_path(output, index) if output else None,
+                **options
+            )
+            for index, (start, end) in enumerate(ranges)
+        ]
+        with sharding.producer_for_queue(celery_app, 'file_processing') as producer:
+            merge = chord(header)(merge_file_results.s(output=output), producer=producer)
+        return {
+            'processed': False,
+            'filename': filename,
+            'split': True,
+            'parts': len(ranges),
+            'merge_task_id': merge.id
+        }
+
+    result = file_pipeline.process_file(filename, output=output, on_progress=report_progress, **options)
+    return {'processed': True, 'filename': filename, 'split': False, **result}
 
 @celery_app.task(name='tasks.process_task', bind=True)
 def process_task(self, task_type, priority='normal', parameters=None, delay=0):
@@ -68,8 +211,8 @@ def process_task(self, task_type, priority='normal', parameters=None, delay=0):
         # Update task state to STARTED
         self.update_state(state='STARTED', meta={'status': 'Task processing started'})
         
-        # Simulate random failure (10% chance)
-        if random.random() < 0.1:
+        # Simulate random failure (10% chance by default)
+        if random.random() < SIMULATED_FAILURE_RATE:
             raise TaskError("Random task failure simulation")
         
         try:
@@ -81,12 +224,20 @@ def process_task(self, task_type, priority='normal', parameters=None, delay=0):
             elif task_type == 'file_processing':
                 result = process_file_task(parameters or {})
             else:
-                raise TaskError(f"Unknown task type: {task_type}")
+                raise InvalidTaskError(f"Unknown task type: {task_type}")
+        except (InvalidTaskError, file_pipeline.PipelineError, data_engine.DataEngineError) as exc:
+            # Bad input fails the same way on every attempt, so fail the task now
+            if not isinstance(exc, InvalidTaskError):
+                exc = InvalidTaskError(str(exc))
+            raise exc
         except Exception as exc:
             # Calculate retry delay with exponential backoff
             retry_delay = min(2 ** self.request.retries * 60, 600)  # Max 10 minutes
             task_logger.warning(f"Task failed, retrying in {retry_delay} seconds. Error: {str(exc)}")
-            raise self.retry(exc=exc, countdown=retry_delay)
+            # Handlers that finished part of the work hand back the parameters for the rest
+            retry_parameters = exc.details.get('retry_parameters') if isinstance(exc, TaskError) else None
+            retry_args = [task_type, priority, retry_parameters, delay] if retry_parameters else None
+            raise self.retry(args=retry_args, exc=exc, countdown=retry_delay)
         
         task_logger.info(f"Task completed successfully: {result}")
         return {
@@ -97,6 +248,9 @@ def process_task(self, task_type, priority='normal', parameters=None, delay=0):
             'delay': delay
         }
     
+    except Retry:
+        # Let Celery schedule the retry, wrapping it would mark the task failed
+        raise
     except TaskError as exc:
         task_logger.error(f"Task failed: {str(exc)}")
         # Raise the exception to properly mark the task as failed
@@ -106,18 +260,91 @@ def process_task(self, task_type, priority='normal', parameters=None, delay=0):
         # Raise the exception to properly mark the task as failed
         raise TaskError(str(exc), {'traceback': traceback.format_exc()})
 
+# Queue each priority class is routed to
+PRIORITY_QUEUES = {
+    'high': 'high_priority',
+    'low': 'low_priority',
+    'normal': 'default'
+}
+
+@celery_app.task(name='tasks.process_file_range')
+def process_file_range(filename, start, end, stages=None, output=None, chunk_size=file_pipeline.DEFAULT_CHUNK_SIZE, use_mmap=False,
+                       max_line_bytes=file_pipeline.DEFAULT_MAX_LINE_BYTES):
+    """Run the file pipeline over one byte range of a split file."""
+    task_logger.info(f"Processing {filename} bytes {start}-{end}")
+    filename = resolve_data_path(filename)
+    output = resolve_data_path(output)
+    return file_pipeline.process_file(
+        filename, stages, start, end, output,
+        chunk_size=chunk_size, use_mmap=use_mmap, on_progress=report_progress,
+        max_line_bytes=max_line_bytes
+    )
+
+@celery_app.task(name='tasks.merge_file_results')
+def merge_file_results(results, output=None):
+    """Merge the per-range results of a split file."""
+    try:
+        merged = file_pipeline.merge_results(results, resolve_data_path(output))
+    except file_pipeline.PipelineError as e:
+        raise TaskError(str(e))
+    task_logger.info(f"Merged {merged['parts']} file parts: {merged}")
+    return merged
+
 def submit_task_with_priority(task_type, priority='normal', parameters=None, delay=0):
     """Submit a task with priority-based routing."""
-    queue = {
-        'high': 'high_priority',
-        'low': 'low_priority',
-        'normal': 'default'
-    }.get(priority, 'default')
+    queue = PRIORITY_QUEUES.get(priority, 'default')
     
-    return process_task.apply_async(
-        args=[task_type, priority, parameters, delay],
-        queue=queue,
-        routing_key=queue
+    # Index before publishing, a fast worker could otherwise record STARTED before PENDING
+    task_id = uuid()
+    index_task_state(task_id, [task_type, priority], 'PENDING')
+    try:
+        # Publish on the broker shard that owns the queue
+        with sharding.producer_for_queue(celery_app, queue) as producer:
+            return process_task.apply_async(
+                args=[task_type, priority, parameters, delay],
+                queue=queue,
+                routing_key=queue,
+                producer=producer,
+                task_id=task_id
+            )
+    except Exception:
+        unindex_task(task_id, [task_type, priority])
+        raise
+
+def index_task_state(task_id, args, state):
+    """Record a process_task state change in the search index."""
+    index = task_index.get_index(celery_app)
+    if index is None or not args:
+        return
+    try:
+        index.record(task_id, args[0], args[1] if len(args) > 1 else 'normal', state)
+    except Exception as e:
+        # The index is best effort, never fail a task over it
+        task_logger.warning(f"Could not index task {task_id} as {state}: {str(e)}")
+
+def unindex_task(task_id, args):
+    """Drop a task that was never published from the search index."""
+    index = task_index.get_index(celery_app)
+    if index is None:
+        return
+    try:
+        index.remove(task_id, args[0], args[1])
+    except Exception as e:
+        task_logger.warning(f"Could not remove task {task_id} from the index: {str(e)}")
+
+def search_tasks(state=None, task_type=None, priority=None, since=None, until=None, limit=50, offset=0):
+    """Query the task search index; raises TaskError if it is not available."""
+    index = task_index.get_index(celery_app)
+    if index is None:
+        raise TaskError("Task search needs TASK_INDEX enabled and a Redis result backend")
+    return index.search(
+        state=state.upper() if state else None,
+        task_type=task_type,
+        priority=priority,
+        since=since,
+        until=until,
+        limit=limit,
+        offset=offset
     )
 
 def get_task_status(task_id):
@@ -135,6 +362,14 @@ def get_task_status(task_id):
                 'status': 'Task has been started',
                 'info': task.info if task.info else None
             }
+        elif task.state == PROGRESS_STATE:
+            info = task.info if isinstance(task.info, dict) else {}
+            response = {
+                'state': task.state,
+                'status': 'Task is in progress',
+                'progress': info.get('progress'),
+                'info': info.get('meta') or None
+            }
         elif task.state == 'RETRY':
             response = {
                 'state': task.state,
@@ -179,7 +414,23 @@ def handle_task_failure(task_id, exception, args, kwargs, traceback, einfo, **kw
     task_logger.error(f"Task args: {args}")
     task_logger.error(f"Task kwargs: {kwargs}")
     task_logger.error(f"Traceback: {traceback}")
+    if getattr(kw.get('sender'), 'name', None) == process_task.name:
+        index_task_state(task_id, args, 'FAILURE')
 
 @task_success.connect
 def handle_task_success(result, **kw):
-    task_logger.info(f"Task completed successfully: {result}")
\ No newline at end of file
+    task_logger.info(f"Task completed successfully: {result}")
+    sender = kw.get('sender')
+    if getattr(sender, 'name', None) == process_task.name:
+        index_task_state(sender.request.id, sender.request.args, 'SUCCESS')
+
+@task_retry.connect
+def handle_task_retry(request, reason, **kw):
+    task_logger.warning(f"Task {request.id} will be retried: {reason}")
+    if getattr(kw.get('sender'), 'name', None) == process_task.name:
+        index_task_state(request.id, request.args, 'RETRY')
+
+@task_prerun.connect
+def handle_task_prerun(task_id, task, args, **kw):
+    if task.name == process_task.name:
+        index_task_state(task_id, args, 'STARTED')
\ No newline at end of file
@@ -0,0 +1,188 @@
+"""Tests for ShardedRedisBackend against in-process Redis doubles.
+
+Run with ``python -m pytest test_sharding.py``. Every client created for a
+host talks to the same in-memory store, so the base instance and each shard
+can be inspected after a chord has run on an embedded worker.
+"""
+import threading
+import time
+
+from celery import Celery, chord
+from celery.contrib.testing.worker import start_worker
+
+import sharding
+
+BASE_URL = 'redis://localhost:6379/0'  # The backend's defaults, used when it has no URL
+SHARD_URLS = ['redis://shard-a:6379/0', 'redis://shard-b:6379/0']
+
+SERVERS = {}
+SERVERS_LOCK = threading.Lock()
+
+
+def _key(value):
+    return value.encode() if isinstance(value, str) else value
+
+
+class FakePubSub:
+    """Subscriptions are accepted but never deliver, tests poll the result keys."""
+
+    def subscribe(self, *channels):
+        pass
+
+    def unsubscribe(self, *channels):
+        pass
+
+    def get_message(self, timeout=None):
+        return None
+
+    def close(self):
+        pass
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        with self.client.lock:
+            return [getattr(self.client, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.commands = []
+
+
+class FakeRedis:
+    """The subset of redis.Redis used by RedisBackend and its chord support."""
+
+    def __init__(self, data):
+        self.data = data
+        self.lock = threading.RLock()
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def pubsub(self, **kwargs):
+        return FakePubSub()
+
+    def publish(self, channel, message):
+        return 0
+
+    def get(self, key):
+        return self.data.get(_key(key))
+
+    def mget(self, keys):
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value):
+        self.data[_key(key)] = _key(str(value) if isinstance(value, int) else value)
+        return True
+
+    def setex(self, key, expires, value):
+        return self.set(key, value)
+
+    def delete(self, *keys):
+        return sum(self.data.pop(_key(key), None) is not None for key in keys)
+
+    def incr(self, key, amount=1):
+        value = int(self.data.get(_key(key), 0)) + amount
+        self.data[_key(key)] = str(value).encode()
+        return value
+
+    def expire(self, key, seconds):
+        return _key(key) in self.data
+
+    def zadd(self, key, mapping):
+        self.data.setdefault(_key(key), {}).update(mapping)
+        return len(mapping)
+
+    def zcount(self, key, low, high):
+        return len(self.data.get(_key(key), {}))
+
+    def zrange(self, key, start, end):
+        members = sorted(self.data.get(_key(key), {}).items(), key=lambda item: float(item[1]))
+        return [member for member, _ in members]
+
+
+class FakeShardedBackend(sharding.ShardedRedisBackend):
+    def _create_client(self, host=None, port=None, db=None, **params):
+        with SERVERS_LOCK:
+            return FakeRedis(SERVERS.setdefault((host, port, db), {}))
+
+
+def _server(url):
+    backend = app.backend
+    params = backend.connparams if url == BASE_URL else backend.shard_params[url]
+    return SERVERS[(params['host'], params['port'], params['db'])]
+
+
+app = Celery('test_sharding', broker='memory://')
+app.conf.update(
+    result_backend=f"{__name__}:FakeShardedBackend",
+    result_backend_shards=SHARD_URLS,
+)
+
+
+@app.task(name='test_sharding.double')
+def double(value):
+    return value * 2
+
+
+@app.task(name='test_sharding.total')
+def total(values):
+    return sum(values)
+
+
+def test_only_task_results_are_sharded():
+    backend = app.backend
+    assert backend.shard_for(backend.get_key_for_task('some-task')) in SHARD_URLS
+    assert backend.shard_for(backend.get_key_for_group('some-group')) is None
+    for suffix in ('.j', '.t', '.s'):
+        assert backend.shard_for(backend.get_key_for_group('some-group', suffix)) is None
+
+
+def test_mget_reads_each_key_from_its_owner():
+    backend = app.backend
+    task_ids = [f"mget-{index}" for index in range(20)]
+    for task_id in task_ids:
+        backend.store_result(task_id, task_id, 'SUCCESS')
+    group_key = backend.get_key_for_group('mget-group', '.s')
+    backend.set(group_key, 3)
+
+    keys = [backend.get_key_for_task(task_id) for task_id in task_ids] + [group_key]
+    values = backend.mget(keys)
+    assert all(value is not None for value in values)
+    assert {backend.shard_for(key) for key in keys[:-1]} == set(SHARD_URLS)
+    assert _key(group_key) in _server(BASE_URL)
+
+
+def test_chord_body_runs_with_sharded_results():
+    with start_worker(app, perform_ping_check=False, shutdown_timeout=10):
+        result = chord(double.s(value) for value in range(10))(total.s())
+        deadline = time.monotonic() + 20
+        while result.state != 'SUCCESS' and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    assert result.state == 'SUCCESS'
+    assert result.result == sum(value * 2 for value in range(10))
+
+    backend = app.backend
+    # Part and body results live on their shards, not on the base instance
+    for task_id in [part.id for part in result.parent.results] + [result.id]:
+        key = _key(backend.get_key_for_task(task_id))
+        assert key in _server(backend.shard_for(key))
+        assert key not in _server(BASE_URL)
+    # The chord keys were read back from the base instance and removed there
+    group_id = result.parent.id
+    for suffix in ('.j', '.t', '.s'):
+        key = _key(backend.get_key_for_group(group_id, suffix))
+        assert all(key not in _server(url) for url in [BASE_URL] + SHARD_URLS)
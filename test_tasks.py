@@ -4,6 +4,7 @@ import json
 import logging
 from concurrent.futures import ThreadPoolExecutor
 import random
+import os
 
 logging.basicConfig(
     level=logging.INFO,
@@ -11,7 +12,7 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-BASE_URL = 'http://13.215.46.60:5000/api'
+BASE_URL = os.getenv('TASK_API_URL', 'http://13.215.46.60:5000/api')
 
 def submit_task(task_type, priority='normal', parameters=None, delay=0):
     url = f"{BASE_URL}/tasks"
@@ -0,0 +1,302 @@
+"""Per-process cache of expensive resources for task handlers.
+
+Handlers fetch things like connection pools, compiled templates or models
+with ``resources.get(name)``. Resources are built lazily on first use, shared
+by every task the process runs, and evicted least recently used first when
+their combined size exceeds ``worker_resource_max_bytes``. Resources
+registered with ``preload=True`` are built once in the parent before the pool
+forks, so they must be safe to share across fork (no open sockets or threads).
+
+The cache follows the worker lifecycle: ``worker_init`` preloads,
+``worker_process_init`` starts a fresh cache in each child and
+``worker_process_shutdown`` closes everything. When a child is recycled
+(``worker_max_tasks_per_child``/``worker_max_memory_per_child``) its build
+cost and task count are added to per-worker counters in the result backend.
+Pool children also publish a snapshot of their cache there after tasks, at
+most every ``worker_resource_stats_interval`` seconds, because under
+``prefork`` control commands are answered by the parent, whose own cache
+stays empty. ``celery -A tasks inspect resource_stats`` reports the
+answering process's cache plus these snapshots under ``children``. The
+``solo`` pool has no child processes, so the per-child signals never fire
+and the worker's one cache is closed at ``worker_shutdown``.
+"""
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+import psutil
+from celery import current_app
+from celery.backends.redis import RedisBackend
+from celery.signals import (task_postrun, worker_init, worker_process_init,
+                            worker_process_shutdown, worker_shutdown)
+from celery.worker.control import inspect_command
+
+import celeryconfig
+
+logger = logging.getLogger(__name__)
+
+STATS_KEY = 'worker_resources:{hostname}'
+PROCESS_STATS_KEY = 'worker_resources:{hostname}:processes'
+PROCESS_STATS_TTL = 24 * 3600
+
+
+class ResourceError(Exception):
+    pass
+
+
+class _Entry:
+    def __init__(self, factory, close=None, size=None, preload=False):
+        self.factory = factory
+        self.close = close
+        self.size = size
+        self.preload = preload
+        self.builds = 0
+        self.build_seconds = 0.0
+        self.hits = 0
+        self.evictions = 0
+
+
+class ResourceManager:
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self.entries = {}
+        self.values = OrderedDict()
+        self.sizes = {}
+        self.is_child = False
+        self.reset_process_stats()
+
+    def reset_process_stats(self):
+        self.pid = os.getpid()
+        self.started = time.time()
+        self.tasks_processed = 0
+        self.last_published = None
+
+    def register(self, name, factory, close=None, size=None, preload=False):
+        """Register a resource.
+
+        factory() builds it, close(value) releases it, size is the value's
+        footprint in bytes (an int or a callable taking the value; by default
+        the process RSS growth while building it).
+        """
+        with self.lock:
+            self.entries[name] = _Entry(factory, close, size, preload)
+
+    def get(self, name, factory=None, close=None, size=None):
+        """Return the resource, building it first if needed.
+
+        Passing a factory registers the resource on first use.
+        """
+        with self.lock:
+            if name in self.values:
+                self.values.move_to_end(name)
+                self.entries[name].hits += 1
+                return self.values[name]
+            if name not in self.entries:
+                if factory is None:
+                    raise ResourceError(f"Unknown resource: {name}")
+                self.register(name, factory, close, size)
+            return self._build(name)
+
+    def _build(self, name):
+        entry = self.entries[name]
+        rss_before = psutil.Process().memory_info().rss
+        begin = time.perf_counter()
+        value = entry.factory()
+        entry.build_seconds += time.perf_counter() - begin
+        entry.builds += 1
+
+        if callable(entry.size):
+            footprint = entry.size(value)
+        elif entry.size is not None:
+            footprint = entry.size
+        else:
+            footprint = max(psutil.Process().memory_info().rss - rss_before, 0)
+        self.values[name] = value
+        self.sizes[name] = footprint
+        logger.info(f"Built resource {name} in {entry.build_seconds:.3f}s ({footprint} bytes)")
+        self._evict(keep=name)
+        return value
+
+    def _evict(self, keep=None):
+        if not self.max_bytes:
+            return
+        for name in list(self.values):
+            if sum(self.sizes.values()) <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            logger.info(f"Evicting resource {name} to stay under {self.max_bytes} bytes")
+            self.entries[name].evictions += 1
+            self.discard(name)
+
+    def discard(self, name, close=True):
+        with self.lock:
+            value = self.values.pop(name, None)
+            self.sizes.pop(name, None)
+            entry = self.entries.get(name)
+            if close and entry and entry.close and value is not None:
+                try:
+                    entry.close(value)
+                except Exception as e:
+                    logger.warning(f"Error closing resource {name}: {str(e)}")
+
+    def preload(self):
+        with self.lock:
+            for name, entry in self.entries.items():
+                if entry.preload and name not in self.values:
+                    self._build(name)
+
+    def after_fork(self):
+        """Start a child's cache: keep preloaded resources, forget anything else."""
+        with self.lock:
+            for name in list(self.values):
+                if not self.entries[name].preload:
+                    # Never close the parent's copy from a child
+                    self.discard(name, close=False)
+            for entry in self.entries.values():
+                entry.builds = entry.hits = entry.evictions = 0
+                entry.build_seconds = 0.0
+            self.is_child = True
+            self.reset_process_stats()
+
+    def close_all(self):
+        with self.lock:
+            for name in list(self.values):
+                self.discard(name)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'pid': self.pid,
+                'uptime': time.time() - self.started,
+                'tasks_processed': self.tasks_processed,
+                'bytes': sum(self.sizes.values()),
+                'max_bytes': self.max_bytes,
+                'build_seconds': sum(entry.build_seconds for entry in self.entries.values()),
+                'resources': {
+                    name: {
+                        'loaded': name in self.values,
+                        'size': self.sizes.get(name),
+                        'builds': entry.builds,
+                        'build_seconds': entry.build_seconds,
+                        'hits': entry.hits,
+                        'evictions': entry.evictions,
+                    }
+                    for name, entry in self.entries.items()
+                },
+            }
+
+
+resources = ResourceManager(max_bytes=celeryconfig.worker_resource_max_bytes)
+
+
+def _stats_client():
+    if not isinstance(current_app.backend, RedisBackend):
+        return None
+    return current_app.backend.client
+
+
+def _record_recycle(hostname, stats):
+    """Add a finished process's cost to the worker's counters in the result backend."""
+    client = _stats_client()
+    if client is None:
+        return
+    key = STATS_KEY.format(hostname=hostname)
+    pipe = client.pipeline()
+    # Its totals are now in the counters, drop the live snapshot
+    pipe.hdel(PROCESS_STATS_KEY.format(hostname=hostname), stats['pid'])
+    pipe.hincrby(key, 'processes', 1)
+    pipe.hincrby(key, 'tasks_processed', stats['tasks_processed'])
+    pipe.hincrbyfloat(key, 'build_seconds', stats['build_seconds'])
+    pipe.hincrbyfloat(key, 'process_seconds', stats['uptime'])
+    pipe.hincrby(key, 'builds', sum(r['builds'] for r in stats['resources'].values()))
+    pipe.execute()
+
+
+def _publish_process_stats(hostname, stats):
+    """Store a child's cache statistics where the pool parent can read them."""
+    client = _stats_client()
+    if client is None:
+        return
+    key = PROCESS_STATS_KEY.format(hostname=hostname)
+    pipe = client.pipeline()
+    pipe.hset(key, stats['pid'], json.dumps(stats))
+    pipe.expire(key, PROCESS_STATS_TTL)
+    pipe.execute()
+
+
+def _children_stats(hostname):
+    """Latest snapshot of each live child, dropping those of processes that are gone."""
+    client = _stats_client()
+    if client is None:
+        return {}
+    key = PROCESS_STATS_KEY.format(hostname=hostname)
+    children = {}
+    for pid, stats in client.hgetall(key).items():
+        pid = pid.decode() if isinstance(pid, bytes) else pid
+        if int(pid) == os.getpid() or not psutil.pid_exists(int(pid)):
+            # Killed children never remove their own snapshot
+            client.hdel(key, pid)
+            continue
+        children[pid] = json.loads(stats)
+    return children
+
+
+@worker_init.connect
+def preload_resources(**kw):
+    resources.preload()
+
+
+@worker_process_init.connect
+def init_process_resources(**kw):
+    resources.after_fork()
+
+
+@task_postrun.connect
+def count_task(**kw):
+    resources.tasks_processed += 1
+    if not resources.is_child:
+        return
+    now = time.monotonic()
+    if resources.last_published is None or now - resources.last_published >= celeryconfig.worker_resource_stats_interval:
+        resources.last_published = now
+        try:
+            _publish_process_stats(socket.gethostname(), resources.stats())
+        except Exception as e:
+            logger.warning(f"Could not publish resource stats: {str(e)}")
+
+
+@worker_process_shutdown.connect
+def shutdown_process_resources(**kw):
+    stats = resources.stats()
+    logger.info(
+        f"Worker process {stats['pid']} exiting after {stats['tasks_processed']} tasks and "
+        f"{stats['uptime']:.0f}s, resource builds cost {stats['build_seconds']:.3f}s"
+    )
+    resources.close_all()
+    try:
+        _record_recycle(socket.gethostname(), stats)
+    except Exception as e:
+        logger.warning(f"Could not record resource stats: {str(e)}")
+
+
+@worker_shutdown.connect
+def shutdown_resources(**kw):
+    resources.close_all()
+
+
+@inspect_command()
+def resource_stats(state):
+    """Cache statistics of the answering process, plus the pool children's latest snapshots."""
+    stats = resources.stats()
+    try:
+        stats['children'] = _children_stats(socket.gethostname())
+    except Exception as e:
+        logger.warning(f"Could not read child resource stats: {str(e)}")
+        stats['children'] = {}
+    return stats